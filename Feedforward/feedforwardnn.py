@@ -10,35 +10,91 @@ Original file is located at
 """
 
 import argparse
-import matplotlib.pyplot as plt 
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np 
 import os
-import pandas as pd
 import pickle 
-from sklearn.decomposition import PCA
+import queue
 import sys
+import threading
+import time
 from pathlib import Path
+# datautils.py at the top of the repository holds the helpers shared with the RBM script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from datautils import BackgroundWriter, file_hash, load_cached_csv, prefetch_iter, save_npy
+# pandas, sklearn, matplotlib and http.server are imported by the functions that need them, so importing this file for the model
+# functions (forward_pass, predict_classes, ...) only loads numpy. The sweeps are run through main.
+
+"""# Flat parameter buffers"""
+
+# All the weights and biases of a network live in one flat float buffer. The dictionaries used everywhere else 
+# ("W1", "b1", ...) only hold reshaped views into it, so an optimizer can update every layer with a single vectorized 
+# operation on the flat buffer. Gradients and optimizer momenta use the same layout.
+# Networks are float32 by default, which halves the memory traffic of the np.dot calls compared to float64. The dtype of 
+# the parameters decides the dtype of the activations and gradients, inputs are cast to it in forward_pass.
+
+def create_layout(num_hidden, sizes, inputsize = 784, outputsize = 10):
+    # List of (key, shape) pairs in the order in which they are stored in the flat buffer
+    sizes = [inputsize] + sizes
+    sizes = sizes + [outputsize]
+    layout = []
+    for i in range(1, num_hidden+2):
+        layout.append(("W" + str(i), (sizes[i], sizes[i-1])))
+        layout.append(("b" + str(i), (sizes[i], 1)))
+    return layout
+
+def create_flat(layout, prefix = "", dtype = np.float32):
+    total = sum([int(np.prod(shape)) for key, shape in layout])
+    flat = np.zeros(total, dtype = dtype)
+    views = {}
+    offset = 0
+    for key, shape in layout:
+        size = int(np.prod(shape))
+        views[prefix + key] = flat[offset:offset + size].reshape(shape)
+        offset = offset + size
+    return flat, views
+
+def flatten(views, dtype = None):
+    # Returns the flat buffer behind a dictionary of views together with the views. Dictionaries that are not backed by 
+    # one buffer (for example the ones read back by load_params), or not of the requested dtype, are copied into a new 
+    # flat buffer.
+    first = next(iter(views.values()))
+    if dtype is None:
+        dtype = first.dtype
+    flat = first.base
+    if flat is not None and flat.ndim == 1 and flat.dtype == dtype and flat.size == sum([np.size(views[key]) for key in views]):
+        if all([views[key].base is flat for key in views]):
+            return flat, views
+    flat, new_views = create_flat([(key, np.shape(views[key])) for key in views], dtype = dtype)
+    for key in views:
+        new_views[key][...] = views[key]
+    return flat, new_views
 
 """# Creating the skeleton of a network"""
 
-def createnetwork(num_hidden, activation_func, sizes, inputsize = 784, outputsize = 10):
+def createnetwork(num_hidden, activation_func, sizes, inputsize = 784, outputsize = 10, dtype = np.float32):
     # Appending the first element(number of inputs=784) and the last element(number of of outputs=10) to sizes array.
     # Sizes is a list representing the number of units in each layer.
     sizes = [inputsize] + sizes
     sizes = sizes + [outputsize]
     # Ex output of the above 2 lines: [784, 50, 100, 150, 10]. If there are 3 hidden layers with 50, 100 and 150 neurons in each layer respectively.
     np.random.seed(1234)
-    # creating a dictionary for all the weights and biases
-    parameters = {}
+    # creating a dictionary for all the weights and biases, backed by one flat buffer
+    _, parameters = create_flat(create_layout(num_hidden, sizes[1:-1], inputsize, outputsize), dtype = dtype)
     if activation_func == "relu":
         for i in range(1, num_hidden+2):
           # Kaiming initialization for W, b i set to zeros
-            parameters["W" + str(i)] = 0.01*np.random.randn(sizes[i], sizes[i-1])*(np.sqrt(2/(sizes[i] + sizes[i-1])))
-            parameters["b" + str(i)] = np.zeros((sizes[i],1))
+            parameters["W" + str(i)][...] = 0.01*np.random.randn(sizes[i], sizes[i-1])*(np.sqrt(2/(sizes[i] + sizes[i-1])))
     else:
         for i in range(1, num_hidden+2):
-            parameters["W" + str(i)] = np.random.randn(sizes[i], sizes[i-1])
-            parameters["b" + str(i)] = np.random.randn(sizes[i],1)
+            parameters["W" + str(i)][...] = np.random.randn(sizes[i], sizes[i-1])
+            parameters["b" + str(i)][...] = np.random.randn(sizes[i],1)
 
     return parameters
 
@@ -51,11 +107,26 @@ def tanh(z):
 	return np.tanh(z)
 
 def softmax(z):
-    z = z-np.max(z)
+    # the largest pre-activation of every column (example) is subtracted so that exp cannot overflow
+    z = z-np.max(z, axis = 0, keepdims = True)
     numer = np.exp(z)
     denom = np.sum(numer, axis = 0)
     return numer/denom
 
+def softmax_cross_entropy(z, Y):
+    # Softmax and cross entropy loss of the output pre-activations z together, one column per example. The loss is taken 
+    # from the log-softmax, log yhat = z - max(z) - log(sum(exp(z - max(z)))), so a saturated output gives a large finite 
+    # loss where log(softmax(z)) gives log(0). Returns the summed loss, yhat and yhat - Y, the gradient of the loss with 
+    # respect to z.
+    Y = np.asarray(Y, dtype = z.dtype)
+    shifted = z - np.max(z, axis = 0, keepdims = True)
+    yhat = np.exp(shifted)
+    denom = np.sum(yhat, axis = 0, keepdims = True)
+    # sum of -Y*log yhat, where the log-sum-exp term of every column is weighted by the sum of its targets
+    loss = np.dot(np.sum(Y, axis = 0), np.log(denom)[0]) - np.einsum("ij,ij->", Y, shifted)
+    yhat /= denom
+    return loss, yhat, yhat - Y
+
 def convert_to_onehot(indices, num_classes):
     output = np.eye(num_classes)[np.array(indices).reshape(-1)]
     # each target vector is converted to a row vector. Each label is now a 10 dimensional vector.
@@ -91,15 +162,20 @@ def cross_entropy_loss(X, Y):
     # loss = np.sum(loss_vec)
     # return loss
 
+"""# Binary dataset cache"""
+
+# Parsing the CSVs with pandas is a large part of the time of a short experiment. The first time a CSV is read it is 
+# converted to .npy files in cache_dir (by default a npy_cache folder next to the CSV): the ids, the pixels as uint8 and, 
+# for labelled files, the labels. The files are keyed by a hash of the CSV, so an edited CSV is converted again, and 
+# every later read is a zero-copy, read-only memory map. See load_cached_csv in datautils.py.
+
 """# Function for reading data and function for activating a neuron"""
 
-def read_data(path_to_csv):
-    df = pd.read_csv(path_to_csv)
-    data = df.to_numpy()
-    X = data[:,1:-1]
-    y = data[:,-1]
-    Y = [int(i) for i in y]
-    return data, X.T, Y
+def read_data(path_to_csv, cache_dir = None):
+    # data is the memory-mapped (examples, pixels) block, its transpose has one column per example
+    _, data, y = load_cached_csv(path_to_csv, labelled = True, cache_dir = cache_dir)
+    Y = np.asarray(y, dtype = int)
+    return data, data.T, Y
 
 def activate(z, activation):
     if activation == "sigmoid":
@@ -109,13 +185,29 @@ def activate(z, activation):
     elif activation == "relu":
         return (z>0)*(z) + 0.01*((z<0)*z)
 
+def activate_inplace(z, activation):
+    # Same as activate but overwrites z, used by the inference path
+    if activation == "sigmoid":
+        np.negative(z, out = z)
+        np.exp(z, out = z)
+        z += 1
+        np.reciprocal(z, out = z)
+    elif activation == "tanh":
+        np.tanh(z, out = z)
+    elif activation == "relu":
+        np.multiply(z, 0.01, out = z, where = z < 0)
+    return z
+
 """# Forward pass function"""
 
-def forward_pass(X, parameters, activation, num_hidden):
+def forward_pass(X, parameters, activation, num_hidden, Y = None):
+    # With targets Y the output layer goes through softmax_cross_entropy and the cross entropy loss and its gradient with 
+    # respect to the output pre-activations are returned as well: yhat, A, H, loss, da
     A = {}
     # To prevent broadcasting when a single input vector is given
     if X.ndim == 1:
         X = X[:, np.newaxis] 
+    X = np.asarray(X, dtype = parameters["W1"].dtype)
 
     #  Initializing the pre-activation to inputs 
     H = {"h0":X}
@@ -130,25 +222,78 @@ def forward_pass(X, parameters, activation, num_hidden):
         
         if l != num_hidden + 1: 
             hl = activate(al, activation)
-        elif l == num_hidden + 1:
+        elif Y is None:
             hl = softmax(al)
+        else:
+            loss, hl, da = softmax_cross_entropy(al, Y)
         H["h" + str(l)] = hl
 
     yhat = H["h" + str(num_hidden + 1)]
+    if Y is not None:
+        return yhat, A, H, loss, da
     return yhat, A, H
 
+"""# Inference only forward pass"""
+
+# forward_pass keeps every A and H for back_prop. For predictions none of that is needed: iterate_inference pushes X 
+# through the network chunk_size columns at a time and every layer writes into one of two preallocated ping-pong 
+# buffers, so the memory used does not depend on the number of examples.
+
+def iterate_inference(X, parameters, activation, num_hidden, chunk_size = 4096, logits = False):
+    # Yields (j, yhat) where yhat holds the softmax outputs of columns j, j+1, ... of X, or the pre-activations of the 
+    # output layer with logits = True. yhat is a view into the ping-pong buffers and is overwritten by the next chunk.
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    num_examples = np.shape(X)[1]
+    chunk_size = max(1, min(chunk_size, num_examples))
+    max_width = max([np.shape(parameters["W" + str(l)])[0] for l in range(1, num_hidden + 2)])
+    dtype = parameters["W1"].dtype
+    buffers = [np.empty(max_width*chunk_size, dtype = dtype), np.empty(max_width*chunk_size, dtype = dtype)]
+
+    for j in range(0, num_examples, chunk_size):
+        hprev = np.asarray(X[:,j:j + chunk_size], dtype = dtype)
+        m = np.shape(hprev)[1]
+        for l in range(1, num_hidden + 2):
+            Wl = parameters["W" + str(l)]
+            al = buffers[l%2][:np.shape(Wl)[0]*m].reshape(np.shape(Wl)[0], m)
+            np.dot(Wl, hprev, out = al)
+            al += parameters["b" + str(l)]
+            if l != num_hidden + 1:
+                activate_inplace(al, activation)
+            hprev = al
+        if logits:
+            yield j, hprev
+            continue
+        # softmax of the output layer, in place and column by column
+        hprev -= np.max(hprev, axis = 0)
+        np.exp(hprev, out = hprev)
+        hprev /= np.sum(hprev, axis = 0)
+        yield j, hprev
+
+def forward_inference(X, parameters, activation, num_hidden, chunk_size = 4096, out = None):
+    # Returns the same yhat as forward_pass, written into out if it is given
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    for j, yhat in iterate_inference(X, parameters, activation, num_hidden, chunk_size):
+        if out is None:
+            out = np.empty((np.shape(yhat)[0], np.shape(X)[1]), dtype = yhat.dtype)
+        out[:,j:j + np.shape(yhat)[1]] = yhat
+    return out
+
+def predict_classes(X, parameters, activation, num_hidden, chunk_size = 4096):
+    # Only the predicted class of each example is kept
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    classes = np.empty(np.shape(X)[1], dtype = int)
+    for j, yhat in iterate_inference(X, parameters, activation, num_hidden, chunk_size):
+        classes[j:j + np.shape(yhat)[1]] = np.argmax(yhat, axis = 0)
+    return classes
+
 """# Functions for generating gradients"""
 
-def creategrads(num_hidden, sizes, inputsize = 784, outputsize = 10):
-    sizes = [inputsize] + sizes
-    sizes = sizes + [outputsize]
-    grads = {"dh0":np.zeros((inputsize,1)),
-            "da0":np.zeros((inputsize,1))}
-    for i in range(1, num_hidden+2):
-        grads["dW" + str(i)] = np.zeros((sizes[i], sizes[i-1]))
-        grads["db" + str(i)] = np.zeros((sizes[i],1))
-        grads["da" + str(i)] = np.zeros((sizes[i],1))
-        grads["dh" + str(i)] = np.zeros((sizes[i],1))
+def creategrads(num_hidden, sizes, inputsize = 784, outputsize = 10, dtype = np.float32):
+    # Gradients share the layout of the parameters, "dW1" is the gradient of "W1" and so on
+    _, grads = create_flat(create_layout(num_hidden, sizes, inputsize, outputsize), prefix = "d", dtype = dtype)
     return grads
 
 
@@ -159,34 +304,46 @@ def grad_tanh(z):
     return (1 - (np.tanh(z))**2)
 
 def grad_relu(z):
-    return (z>0)*(np.ones(np.shape(z))) + (z<0)*(0.01*np.ones(np.shape(z)))
+    return (z>0).astype(z.dtype) + (z<0).astype(z.dtype)*z.dtype.type(0.01)
 
 """# Function for back propagation"""
 
-def back_prop(H, A, parameters, num_hidden, sizes, Y, Yhat, loss, activation, inputsize, outputsize):
-    grad_one_eg = creategrads(num_hidden, sizes, inputsize = 784, outputsize = 10)
-    A["a0"] = np.zeros((inputsize,1))
+def back_prop(H, A, parameters, num_hidden, sizes, Y, Yhat, loss, activation, inputsize, outputsize, grads_batch = None, da = None):
+    # H, A, Y and Yhat hold one column per example of the minibatch. The returned dW and db are summed over the batch,
+    # so a whole minibatch costs one matrix product per layer instead of one rank-1 product per example.
+    # If grads_batch (from creategrads) is given the gradients are written into it in place. da is the gradient with 
+    # respect to the output pre-activations when it is already known, as from forward_pass with targets.
+    if grads_batch is None:
+        grads_batch = creategrads(num_hidden, sizes, inputsize, outputsize, parameters["W1"].dtype)
     if Y.ndim == 1:
         Y = Y[:, np.newaxis]
     if Yhat.ndim == 1:
         Yhat = Yhat[:, np.newaxis]
+    # the targets take the dtype of the network so that the gradients do too
+    Y = np.asarray(Y, dtype = Yhat.dtype)
 
-    if loss == "ce":
+    if da is not None:
+        pass
+    elif loss == "ce":
       # Derivative of loss function with respect to the pre-activations of the output layer('a').
-        grad_one_eg["da" + str(num_hidden + 1)] = Yhat - Y
+        da = Yhat - Y
     elif loss == "sq":
-        grad_one_eg["da" + str(num_hidden + 1)] = (Yhat - Y)*Yhat - Yhat*(np.dot((Yhat-Y).T, Yhat))
+        # (Yhat-Y).T Yhat of the single example case becomes a column-wise sum over the batch
+        da = (Yhat - Y)*Yhat - Yhat*np.sum((Yhat - Y)*Yhat, axis = 0, keepdims = True)
 
     for i in np.arange(num_hidden + 1, 0, -1):
             # a = b + W*h. 
-            # grad_one_eg["da" + str(i)] this part of the below dot product is calculated at the end of this for loop except for the activation at the output layer.
-
-            # Derivative of loss function with respect to the weight matrix
-            grad_one_eg["dW" + str(i)] = np.dot(grad_one_eg["da" + str(i)], (H["h" + str(i-1)]).T)
-            # Derivative of loss function with respect to the weight matrix
-            grad_one_eg["db" + str(i)] = grad_one_eg["da" + str(i)]
+            # da for the hidden layers is calculated at the end of this for loop except for the activation at the output layer.
+
+            # Derivative of loss function with respect to the weight matrix, summed over the batch
+            np.dot(da, (H["h" + str(i-1)]).T, out = grads_batch["dW" + str(i)])
+            # Derivative of loss function with respect to the bias, summed over the batch
+            np.sum(da, axis = 1, keepdims = True, out = grads_batch["db" + str(i)])
+            # The input layer has no pre-activation, so there is nothing more to propagate
+            if i == 1:
+                break
             # Derivative of loss function wrt activation 'h'. 
-            grad_one_eg["dh" + str(i-1)] = np.dot((parameters["W" + str(i)]).T, grad_one_eg["da" + str(i)])
+            dh = np.dot((parameters["W" + str(i)]).T, da)
 
             if activation == "sigmoid":
                 derv = grad_sigmoid(A["a" + str(i-1)])
@@ -194,33 +351,153 @@ def back_prop(H, A, parameters, num_hidden, sizes, Y, Yhat, loss, activation, in
                 derv = grad_tanh(A["a" + str(i-1)])
             elif activation == "relu":
                 derv = grad_relu(A["a" + str(i-1)])
-            if derv.ndim == 1:
-                derv = derv[:, np.newaxis]
             # Derivative of w.r.t to pre-activations('a') of the hidden layers. 
-            grad_one_eg["da" + str(i-1)] = (grad_one_eg["dh" + str(i-1)])*derv
+            da = dh*derv
 
-    return grad_one_eg
+    return grads_batch
 
 """# Generating momenta"""
 
-def createmomenta(num_hidden, sizes, inputsize = 784, outputsize = 10):
-    sizes = [inputsize] + sizes
-    sizes = sizes + [outputsize]
-    momenta = {}
-    for i in range(1, num_hidden+2):
-        momenta["vW" + str(i)] = np.zeros((sizes[i], sizes[i-1]))
-        momenta["vb" + str(i)] = np.zeros((sizes[i],1))
+def createmomenta(num_hidden, sizes, inputsize = 784, outputsize = 10, dtype = np.float32):
+    _, momenta = create_flat(create_layout(num_hidden, sizes, inputsize, outputsize), prefix = "v", dtype = dtype)
     return momenta
 
-def createmomenta_squared(num_hidden, sizes, inputsize = 784, outputsize = 10):
-    sizes = [inputsize] + sizes
-    sizes = sizes + [outputsize]
-    momenta = {}
-    for i in range(1, num_hidden+2):
-        momenta["mW" + str(i)] = np.zeros((sizes[i], sizes[i-1]))
-        momenta["mb" + str(i)] = np.zeros((sizes[i],1))
+def createmomenta_squared(num_hidden, sizes, inputsize = 784, outputsize = 10, dtype = np.float32):
+    _, momenta = create_flat(create_layout(num_hidden, sizes, inputsize, outputsize), prefix = "m", dtype = dtype)
     return momenta
 
+"""# Optimizers"""
+
+# An optimizer owns the flat gradient buffer that back_prop writes into, its momenta and one scratch buffer, all 
+# allocated once with the layout of the parameters. train() only talks to it through three methods:
+#   zero()  clears the gradient buffer before a batch
+#   step()  applies one update to every layer, given the number of examples the gradients were summed over
+#   state() returns the learning rate, the step counter and the momenta buffers by name
+# load_state() copies such a state back in place.
+# A new update rule only has to implement update(); the training loop is shared by all of them.
+# update() works on flat_master. With master_weights = True a float32 network keeps a float64 copy of its weights, and 
+# float64 momenta, that accumulate the updates; the float32 weights used by forward_pass and back_prop are refreshed from 
+# it after every step. Otherwise flat_master is the parameter buffer itself.
+
+class Optimizer:
+    def __init__(self, params, eta, master_weights = False):
+        self.flat_params, self.params = flatten(params)
+        self.layout = [(key, np.shape(self.params[key])) for key in self.params]
+        self.flat_grads, self.grads = create_flat(self.layout, prefix = "d", dtype = self.flat_params.dtype)
+        if master_weights and self.flat_params.dtype != np.float64:
+            self.flat_master = self.flat_params.astype(np.float64)
+        else:
+            self.flat_master = self.flat_params
+        self.dtype = self.flat_master.dtype
+        self.scratch = np.zeros_like(self.flat_master)
+        self.eta = eta
+        self.t = 0
+
+    def zero(self):
+        self.flat_grads.fill(0)
+
+    def step(self, batch_size):
+        self.t = self.t + 1
+        self.update(batch_size)
+        if self.flat_master is not self.flat_params:
+            np.copyto(self.flat_params, self.flat_master, casting = "same_kind")
+
+    def set_params(self, flat_params):
+        # overwrites the weights, for example when annealing rolls back to an earlier epoch
+        self.flat_params[...] = flat_params
+        if self.flat_master is not self.flat_params:
+            self.flat_master[...] = flat_params
+
+    def update(self, batch_size):
+        raise NotImplementedError
+
+    def momenta_buffers(self):
+        return {}
+
+    def state(self):
+        state = {"eta": self.eta, "t": self.t}
+        state.update(self.momenta_buffers())
+        return state
+
+    def load_state(self, state):
+        # keys that are missing from state are left as they are
+        self.eta = state.get("eta", self.eta)
+        self.t = state.get("t", self.t)
+        buffers = self.momenta_buffers()
+        for name in buffers:
+            if name in state:
+                buffers[name][...] = state[name]
+
+class SGDOptimizer(Optimizer):
+    # Plain gradient descent on the gradients averaged over the batch
+    def update(self, batch_size):
+        np.multiply(self.flat_grads, self.eta/batch_size, out = self.scratch)
+        self.flat_master -= self.scratch
+
+class MomentumOptimizer(Optimizer):
+    def __init__(self, params, eta, gamma, master_weights = False):
+        Optimizer.__init__(self, params, eta, master_weights)
+        self.gamma = gamma
+        self.flat_momenta, self.momenta = create_flat(self.layout, prefix = "v", dtype = self.dtype)
+
+    def update(self, batch_size):
+        self.flat_momenta *= self.gamma
+        np.multiply(self.flat_grads, self.eta, out = self.scratch)
+        self.flat_momenta += self.scratch
+        self.flat_master -= self.flat_momenta
+
+    def momenta_buffers(self):
+        return {"momenta": self.flat_momenta}
+
+class NAGOptimizer(MomentumOptimizer):
+    def update(self, batch_size):
+        MomentumOptimizer.update(self, batch_size)
+        # look ahead along the momentum before the gradient of the next batch is computed
+        np.multiply(self.flat_momenta, self.gamma, out = self.scratch)
+        self.flat_master -= self.scratch
+
+class AdamOptimizer(Optimizer):
+    def __init__(self, params, eta, beta1 = 0.9, beta2 = 0.999, eps = 1e-8, master_weights = False):
+        Optimizer.__init__(self, params, eta, master_weights)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+        # momenta holds the running average of the squared gradients and momenta_squared the running average of the gradients
+        self.flat_momenta, self.momenta = create_flat(self.layout, prefix = "v", dtype = self.dtype)
+        self.flat_momenta_squared, self.momenta_squared = create_flat(self.layout, prefix = "m", dtype = self.dtype)
+
+    def update(self, batch_size):
+        scratch = self.scratch
+        self.flat_momenta *= self.beta2
+        np.square(self.flat_grads, out = scratch)
+        scratch *= (1 - self.beta2)
+        self.flat_momenta += scratch
+
+        self.flat_momenta_squared *= self.beta1
+        np.multiply(self.flat_grads, 1 - self.beta1, out = scratch)
+        self.flat_momenta_squared += scratch
+
+        # params -= eta*momenta_squared_hat/sqrt(momenta_hat + eps), with the bias corrections folded into scalars
+        np.multiply(self.flat_momenta, 1/(1 - np.power(self.beta2, self.t)), out = scratch)
+        scratch += self.eps
+        np.sqrt(scratch, out = scratch)
+        np.divide(self.flat_momenta_squared, scratch, out = scratch)
+        scratch *= self.eta/(1 - np.power(self.beta1, self.t))
+        self.flat_master -= scratch
+
+    def momenta_buffers(self):
+        return {"momenta": self.flat_momenta, "momenta_squared": self.flat_momenta_squared}
+
+def create_optimizer(optim, params, eta, gamma = 0.5, beta1 = 0.9, beta2 = 0.999, eps = 1e-8, master_weights = False):
+    if optim == "gd":
+        return SGDOptimizer(params, eta, master_weights)
+    elif optim == "momentum":
+        return MomentumOptimizer(params, eta, gamma, master_weights)
+    elif optim == "nag":
+        return NAGOptimizer(params, eta, gamma, master_weights)
+    elif optim == "adam":
+        return AdamOptimizer(params, eta, beta1, beta2, eps, master_weights)
+
 """# Functions for finding the accuracy and reading the test data"""
 
 def find_accuracy(yhat,y):
@@ -228,36 +505,79 @@ def find_accuracy(yhat,y):
     b = np.argmax(y, axis = 0)
     return 100*(np.sum(a == b)/len(a))
 
-def read_data_test(path_to_csv):
-    df = pd.read_csv(path_to_csv)
-    data = df.to_numpy()
-    X = data[:,1:]
-    indices = data[:,0]
-    return data, X.T, indices
+def read_data_test(path_to_csv, cache_dir = None):
+    indices, data, _ = load_cached_csv(path_to_csv, labelled = False, cache_dir = cache_dir)
+    return data, data.T, indices
 
 """# Measuring the performance and displaying output information"""
 
-def measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss):
-    # Performing forward pass on training set
-    Yhat, _, _ = forward_pass(X, params, activation_func, num_hidden)
-    train_acc = find_accuracy(Yhat, Y)
-    train_err = 100 - train_acc
-    if loss == "ce":
-        train_loss = (cross_entropy_loss(Yhat,Y))
+# Losses are sums over the examples, as in cross_entropy_loss and squared_loss, so every estimate below is scaled to the 
+# number of examples in the set it stands for.
+
+def count_correct(Yhat, Y):
+    return np.sum(np.argmax(Yhat, axis = 0) == np.argmax(Y, axis = 0))
+
+def batch_metrics(Yhat, Y, loss, logits = False):
+    # number of correctly classified examples and the summed loss of one batch. With logits = True Yhat holds the 
+    # pre-activations of the output layer (the argmax is the same) and the cross entropy is taken from them
+    correct = count_correct(Yhat, Y)
+    if loss == "ce" and logits:
+        return correct, softmax_cross_entropy(Yhat, Y)[0]
+    elif loss == "ce":
+        return correct, cross_entropy_loss(Yhat, Y)
     elif loss == "sq":
-        train_loss = (squared_loss(Yhat,Y))
-    
+        if logits:
+            Yhat = softmax(Yhat)
+        return correct, squared_loss(Yhat, Y)
+
+def evaluate(X, Y, params, activation_func, num_hidden, loss, chunk_size = None):
+    # Error and loss over the whole of X. With chunk_size only that many columns are pushed through the network at a 
+    # time (see iterate_inference), so memory does not grow with the size of the set.
+    num_examples = np.shape(X)[1]
+    if chunk_size is None:
+        chunk_size = num_examples
+    correct = 0
+    total_loss = 0
+    # the cross entropy is computed from the pre-activations, see softmax_cross_entropy
+    logits = loss == "ce"
+    for j, Yhat in iterate_inference(X, params, activation_func, num_hidden, chunk_size, logits):
+        batch_correct, batch_loss = batch_metrics(Yhat, Y[:,j:j + chunk_size], loss, logits)
+        correct = correct + batch_correct
+        total_loss = total_loss + batch_loss
+    return 100 - 100*(correct/num_examples), total_loss
+
+def measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss, chunk_size = None):
+    # Performing forward pass on training set
+    train_err, train_loss = evaluate(X, Y, params, activation_func, num_hidden, loss, chunk_size)
     # Performing forward pass on validation set
-    Yhat_val, _, _ = forward_pass(X_val, params, activation_func, num_hidden)
-    val_acc = find_accuracy(Yhat_val, Y_val)
-    val_err = 100 - val_acc
-    if loss == "ce":
-        valid_loss = cross_entropy_loss(Yhat_val, Y_val)
-    elif loss == "sq":
-        valid_loss = (squared_loss(Yhat_val, Y_val))
-
+    val_err, valid_loss = evaluate(X_val, Y_val, params, activation_func, num_hidden, loss, chunk_size)
     return train_err, train_loss, val_err, valid_loss
 
+# The training metrics that are logged during training can come from three places, chosen with eval_mode:
+#   "full"       a forward pass over the whole training set, as measure_performance does
+#   "running"    the losses of the forward passes train() already made since the last log, at no extra cost
+#   "subsample"  a fixed random subsample of eval_subsample training examples, drawn once per run
+# The validation set is always evaluated in full, in chunks of eval_chunk examples.
+
+def create_eval_subsample(X, Y, eval_subsample, seed = 1234):
+    num_examples = np.shape(X)[1]
+    rng = np.random.default_rng(seed)
+    indices = np.sort(rng.choice(num_examples, size = min(eval_subsample, num_examples), replace = False))
+    return X[:, indices], Y[:, indices]
+
+def measure_training(X, Y, params, activation_func, num_hidden, loss, eval_mode, running, X_eval = None, Y_eval = None, chunk_size = None):
+    # running is [correct, loss, examples] accumulated by train() and is reset here
+    num_examples = np.shape(X)[1]
+    if eval_mode == "running" and running[2] > 0:
+        train_err = 100 - 100*(running[0]/running[2])
+        train_loss = running[1]*(num_examples/running[2])
+        running[:] = 0
+        return train_err, train_loss
+    elif eval_mode == "subsample":
+        train_err, train_loss = evaluate(X_eval, Y_eval, params, activation_func, num_hidden, loss, chunk_size)
+        return train_err, train_loss*(num_examples/np.shape(X_eval)[1])
+    return evaluate(X, Y, params, activation_func, num_hidden, loss, chunk_size)
+
 def display_info(epoch, train_err, train_loss, val_err, valid_loss):
     print("epoch:" + str(epoch))       
     print("train error: ", "%.2f" % train_err, " train loss: ", "%.2f" % train_loss, 
@@ -266,12 +586,12 @@ def display_info(epoch, train_err, train_loss, val_err, valid_loss):
 
 """# Functions for creating submissions and log files"""
 
-def create_submission(X_test, indices, params, activation_func, num_hidden, submission_path):
-    # Prediction on the test data set
-    Yhat_test, _, _ = forward_pass(X_test, params, activation_func, num_hidden)
-    Yhat_test_classes = np.argmax(Yhat_test, axis = 0)
+def create_submission(X_test, indices, params, activation_func, num_hidden, submission_path, chunk_size = 4096):
+    # Prediction on the test data set, chunk_size examples at a time
+    Yhat_test_classes = predict_classes(X_test, params, activation_func, num_hidden, chunk_size)
     output = np.array([indices, Yhat_test_classes])
     output = output.T
+    import pandas as pd
     sub = pd.DataFrame({"id": output[:,0], "label": output[:,1]})
     _ = sub.to_csv(submission_path, index = False)
     print("Created submission at " + submission_path)
@@ -318,318 +638,492 @@ def create_readme(path_expt_dir, run_details):
     f.write
     f.close()
 
-"""# Function for Adam"""
-
-def adam(X, Y, X_val, Y_val, activation_func, loss_func, eta, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
- inputsize = 784, outputsize = 10, beta1 = 0.9, beta2 = 0.999, eps = 1e-8, anneal = True, pretrain = False, state = 0):
-    print("Adam optimizer is being used.")
-    step_data = {}
-    epoch_data = []
-
+"""# Minibatch samplers"""
+
+# A sampler decides which examples go into each minibatch of an epoch. Iterating over it yields one array of example 
+# indices per minibatch, sorted so that the gathers read the data in increasing order. Sampler visits the examples in 
+# file order (shuffle = False) or in a new random permutation every epoch; StratifiedSampler also shuffles every epoch 
+# but spreads every class evenly over the epoch, so each minibatch has about the class proportions of the whole dataset.
+# The next iteration starts at batch skip of its epoch, which is how train resumes in the middle of an epoch. rng_state 
+# gives the state of the random generator that reproduces the order of the current epoch (step > 0) or of the next one.
+
+class Sampler:
+    def __init__(self, num_examples, batch_size, shuffle = True, seed = 1234):
+        self.num_examples = num_examples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.epoch_rng = self.rng.bit_generator.state
+        self.skip = 0
+
+    def __len__(self):
+        return -(-self.num_examples//self.batch_size)
+
+    def order(self):
+        if self.shuffle:
+            return self.rng.permutation(self.num_examples)
+        return np.arange(self.num_examples)
+
+    def rng_state(self, step):
+        return self.epoch_rng if step > 0 else self.rng.bit_generator.state
+
+    def __iter__(self):
+        self.epoch_rng = self.rng.bit_generator.state
+        order = self.order()
+        start = self.skip*self.batch_size
+        self.skip = 0
+        for j in range(start, self.num_examples, self.batch_size):
+            yield np.sort(order[j:j + self.batch_size])
+
+class StratifiedSampler(Sampler):
+    def __init__(self, labels, batch_size, seed = 1234):
+        Sampler.__init__(self, len(labels), batch_size, True, seed)
+        self.classes = [np.flatnonzero(labels == label) for label in np.unique(labels)]
+
+    def order(self):
+        # The examples of a class get evenly spaced keys in [0, 1) in a random order and with a random offset, so sorting 
+        # the keys of all the classes interleaves them in proportion
+        keys = np.empty(self.num_examples)
+        for indices in self.classes:
+            count = len(indices)
+            keys[self.rng.permutation(indices)] = (np.arange(count) + self.rng.random())/count
+        return np.argsort(keys, kind = "stable")
+
+def create_sampler(sampling, Y, batch_size, seed = 1234):
+    # Y holds one one-hot column per example
+    if sampling == "sequential":
+        return Sampler(np.shape(Y)[1], batch_size, False, seed)
+    elif sampling == "shuffle":
+        return Sampler(np.shape(Y)[1], batch_size, True, seed)
+    elif sampling == "stratified":
+        return StratifiedSampler(np.argmax(Y, axis = 0), batch_size, seed)
+
+def gather_batches(X, Y, sampler):
+    # Yields the (x, y) minibatches of one epoch with one column per example. The examples are gathered as rows of X.T and 
+    # Y.T, which are row major for the arrays of init_data, into buffers allocated once per batch size and reused, so a 
+    # minibatch is only valid until the next one is taken.
+    buffers = {}
+    for indices in sampler:
+        m = len(indices)
+        if m not in buffers:
+            buffers[m] = (np.empty((m, np.shape(X)[0]), dtype = X.dtype), np.empty((m, np.shape(Y)[0]), dtype = Y.dtype))
+        x, y = buffers[m]
+        np.take(X.T, indices, axis = 0, out = x)
+        np.take(Y.T, indices, axis = 0, out = y)
+        yield x.T, y.T
+
+"""# Streaming minibatch loader"""
+
+# MinibatchLoader streams minibatches out of row-major data (one row per example), such as the memory maps returned by 
+# load_cached_csv and load_projected, so a dataset never has to be loaded or transposed in memory as a whole. A background 
+# thread gathers the rows of the next batches, applies transform (for example the /255 normalization) and keeps up to 
+# prefetch batches ready in a queue, which overlaps the disk reads and the normalization with the training step. 
+# Iterating over the loader yields (x, y) with one column per example, like gather_batches. The examples of each batch 
+# come from sampler, by default a Sampler that shuffles every epoch.
+
+class MinibatchLoader:
+    def __init__(self, X, Y = None, batch_size = 20, shuffle = True, transform = None, prefetch = 4, seed = 1234, sampler = None):
+        self.X = X
+        self.Y = Y
+        self.transform = transform
+        self.prefetch = prefetch
+        if sampler is None:
+            sampler = Sampler(np.shape(X)[0], batch_size, shuffle, seed)
+        self.sampler = sampler
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def batches(self):
+        # the indices of a batch are sorted, which turns the gather into a forward scan over the memory map
+        for indices in self.sampler:
+            x = np.asarray(self.X[indices])
+            if self.transform is not None:
+                x = self.transform(x)
+            y = None if self.Y is None else np.asarray(self.Y[indices]).T
+            yield x.T, y
+
+    def __iter__(self):
+        return prefetch_iter(self.batches(), self.prefetch)
+
+"""# Checkpoints"""
+
+# CheckpointManager keeps the state of the last kept epoch in memory: the weights (the float64 master copy when there is 
+# one), the step counter and the optimizer momenta, copied into buffers allocated once. An anneal rollback copies them 
+# back, which is instant and also restores the momenta, unlike reloading the pickled weights. The learning rate is not 
+# part of the snapshot, train halves it after the rollback. anneals counts the rollbacks since the last kept epoch.
+# The weights of every kept epoch are also pickled to path_save_dir by a BackgroundWriter thread, so that load_params and 
+# pretrain keep working, and only the newest keep files are left on disk (keep = None keeps all of them).
+#
+# save_state writes the whole training state to path_save_dir + "checkpoint.npz", through the same background thread and 
+# a temporary file that is renamed into place, so the file on disk is always a complete checkpoint. It holds the weights, 
+# the float64 master weights, the momenta, the step counter and the learning rate of the optimizer, the in-memory 
+# snapshot, the epoch and minibatch to go on from, step_data, epoch_data, the running metrics and the random state of 
+# the sampler. restore_state puts all of it back, so train(resume = True) carries on at the exact minibatch where the 
+# checkpoint was taken. The checkpoint also records a signature of the run: the optimizer, the dtype of the weights and 
+# of the master copy, the names and shapes of the parameters and the settings train passes in (activation, loss, batch 
+# size, sampler). restore_state refuses to resume from a checkpoint whose signature differs.
+
+def save_training_state(path, arrays):
+    # the first checkpoint can come before the first pickled epoch, so the folder may not exist yet
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as handle:
+        np.savez(handle, **arrays)
+    os.replace(tmp_path, path)
+
+def load_training_state(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+class CheckpointManager:
+    def __init__(self, optimizer, path_save_dir, keep = 2, persist = True, settings = None):
+        self.optimizer = optimizer
+        self.settings = settings if settings is not None else {}
+        self.path_save_dir = path_save_dir
+        self.keep = keep
+        self.persist = persist
+        self.snapshot = {}
+        self.epoch = None
+        self.anneals = 0
+        self.saved = []
+        self.writes = BackgroundWriter(maxsize = 2)
+        self.path_state = path_save_dir + "checkpoint.npz"
+
+    def save(self, epoch):
+        state = self.optimizer.state()
+        state.pop("eta")
+        state["params"] = self.optimizer.flat_master
+        for name in state:
+            if np.ndim(state[name]) == 0:
+                self.snapshot[name] = state[name]
+            elif name in self.snapshot:
+                self.snapshot[name][...] = state[name]
+            else:
+                self.snapshot[name] = np.copy(state[name])
+        self.epoch = epoch
+        self.anneals = 0
+        if self.persist:
+            self.write(epoch)
+
+    def restore(self):
+        # returns the epoch that was rolled back to
+        self.optimizer.set_params(self.snapshot["params"])
+        self.optimizer.load_state(self.snapshot)
+        self.anneals = self.anneals + 1
+        return self.epoch
+
+    def write(self, epoch):
+        # the weights are copied because training goes on changing them while they are written
+        params = {key: np.copy(self.optimizer.params[key]) for key in self.optimizer.params}
+        self.writes.put(self.write_params, epoch, params)
+
+    def write_params(self, epoch, params):
+        pickle_params(params, epoch, self.path_save_dir)
+        self.saved.append(epoch)
+        while self.keep is not None and len(self.saved) > self.keep:
+            os.remove(self.path_save_dir + "weights_" + str(self.saved.pop(0)) + ".pickle")
+
+    def save_state(self, epoch, step, step_data, epoch_data, running, sampler = None):
+        optimizer = self.optimizer
+        arrays = {"epoch": epoch, "step": step, "eta": optimizer.eta, "t": optimizer.t, "params": np.copy(optimizer.flat_params)}
+        if optimizer.flat_master is not optimizer.flat_params:
+            arrays["master"] = np.copy(optimizer.flat_master)
+        for name, buffer in optimizer.momenta_buffers().items():
+            arrays["optimizer_" + name] = np.copy(buffer)
+        for name in self.snapshot:
+            arrays["snapshot_" + name] = np.copy(self.snapshot[name])
+        arrays["snapshot_epoch"] = -1 if self.epoch is None else self.epoch
+        arrays["anneals"] = self.anneals
+        keys = list(step_data.keys())
+        arrays["step_keys"] = np.array(keys, dtype = int).reshape(-1, 2)
+        arrays["step_values"] = np.array([step_data[key] for key in keys], dtype = float).reshape(-1, 5)
+        arrays["epoch_data"] = np.array(epoch_data, dtype = float).reshape(-1, 3)
+        arrays["running"] = np.copy(running)
+        if sampler is not None:
+            arrays["sampler_rng"] = np.array(json.dumps(sampler.rng_state(step)))
+        arrays["signature"] = np.array(self.signature())
+        self.writes.put(save_training_state, self.path_state, arrays)
+
+    def signature(self):
+        optimizer = self.optimizer
+        signature = {"optimizer": type(optimizer).__name__, "params": [[key, list(shape)] for key, shape in optimizer.layout],
+            "dtype": optimizer.flat_params.dtype.str, "master_dtype": optimizer.flat_master.dtype.str}
+        signature.update(self.settings)
+        return json.dumps(signature, sort_keys = True)
+
+    def restore_state(self, running, sampler = None):
+        # returns the epoch and step to go on from, step_data and epoch_data. running is restored in place
+        state = load_training_state(self.path_state)
+        saved = str(state["signature"]) if "signature" in state else "unknown"
+        if saved != self.signature():
+            raise ValueError("cannot resume from " + self.path_state + ", it was written by a different run "
+                "(checkpoint: " + saved + ", this run: " + self.signature() + "). Delete it or use another "
+                "path_save_dir to start a new run.")
+        optimizer = self.optimizer
+        optimizer.set_params(state["master"] if "master" in state else state["params"])
+        optimizer.load_state({"eta": float(state["eta"]), "t": int(state["t"])})
+        optimizer.load_state({name[len("optimizer_"):]: state[name] for name in state if name.startswith("optimizer_")})
+        self.snapshot = {name[len("snapshot_"):]: state[name] for name in state if name.startswith("snapshot_")}
+        self.epoch = int(self.snapshot.pop("epoch"))
+        self.epoch = None if self.epoch < 0 else self.epoch
+        if "t" in self.snapshot:
+            self.snapshot["t"] = int(self.snapshot["t"])
+        self.anneals = int(state["anneals"]) if "anneals" in state else 0
+        step_data = {(int(key[0]), int(key[1])): list(values) for key, values in zip(state["step_keys"], state["step_values"])}
+        epoch_data = [[int(row[0]), row[1], row[2]] for row in state["epoch_data"]]
+        running[...] = state["running"]
+        # the weight pickles of the kept epochs that are still on disk count towards keep again
+        self.saved = [row[0] for row in epoch_data if os.path.exists(self.path_save_dir + "weights_" + str(row[0]) + ".pickle")]
+        if sampler is not None and "sampler_rng" in state:
+            sampler.rng.bit_generator.state = json.loads(str(state["sampler_rng"]))
+        return int(state["epoch"]), int(state["step"]), step_data, epoch_data
+
+    def close(self):
+        # waits for the pending writes
+        self.writes.close()
+
+"""# Training loop"""
+
+def init_params(num_hidden, activation_func, sizes, path_save_dir, inputsize = 784, outputsize = 10, pretrain = False, state = 0,
+ dtype = np.float32):
     if pretrain == False:
-        params = createnetwork(num_hidden, activation_func, sizes, inputsize, outputsize)
+        return createnetwork(num_hidden, activation_func, sizes, inputsize, outputsize, dtype)
     elif pretrain == True:
-        params = load_params(path_save_dir, state)
-
-    prev_momenta = createmomenta(num_hidden, sizes, inputsize, outputsize)
-    momenta = createmomenta(num_hidden, sizes, inputsize, outputsize)
-    momenta_hat = createmomenta(num_hidden, sizes, inputsize, outputsize)
-
-    prev_momenta_squared = createmomenta_squared(num_hidden, sizes, inputsize, outputsize)
-    momenta_squared = createmomenta_squared(num_hidden, sizes, inputsize, outputsize)
-    momenta_squared_hat = createmomenta_squared(num_hidden, sizes, inputsize, outputsize)
-    pointsseen = 0
-    epoch = 0
-    while epoch < (num_epochs):
-        grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-        step = 0
-        for j in range(0, 55000):
-            x = X[:,j]
-            y = Y[:,j]
-            yhat, A, H = forward_pass(x, params, activation_func, num_hidden)
-            grad_current = back_prop(H, A, params, num_hidden, sizes, y, yhat, loss_func, activation_func, inputsize, outputsize)
-            for key in grads:
-                grads[key] = grads[key] + grad_current[key]
-            pointsseen = pointsseen + 1
-
-            if pointsseen% batch_size == 0:
-                step = step + 1
-
-                for newkey in params:
-                  #  My stuff
-                    momenta["v" + newkey] = beta2*prev_momenta["v" + newkey] + (1 - beta2)*((grads["d" + newkey])**2)
-                    momenta_squared["m" + newkey] = beta1*prev_momenta_squared["m" + newkey] + (1 - beta1)*((grads["d" + newkey])**1)
-
-                    momenta_hat["v" + newkey] = momenta["v" + newkey]/(1 - np.power(beta2, step)) 
-                    momenta_squared_hat["m" + newkey] = momenta_squared["m" + newkey]/(1 - np.power(beta1, step))
-
-                    params[newkey] = params[newkey] - (eta/np.sqrt(momenta_hat["v" + newkey] + eps))*momenta_squared_hat["m" + newkey]
-
-                    prev_momenta["v" + newkey] = momenta["v" + newkey]
-                    prev_momenta_squared["m" + newkey] = momenta_squared["m" + newkey]
-
-
-                  # His stuff
-                    # momenta["v" + newkey] = beta1*prev_momenta["v" + newkey] + (1 - beta1)*grads["d" + newkey]
-                    # momenta_squared["m" + newkey] = beta2*prev_momenta_squared["m" + newkey] + (1 - beta2)*((grads["d" + newkey])**2)
-
-                    # momenta_hat["v" + newkey] = momenta["v" + newkey]/(1 - np.power(beta1, step)) 
-                    # momenta_squared_hat["m" + newkey] = momenta_squared["m" + newkey]/(1 - np.power(beta2, step))
-
-                    # params[newkey] = params[newkey] - (eta/np.sqrt(momenta_squared_hat["m" + newkey] + eps))*momenta_hat["v" + newkey]
-
-                    # prev_momenta["v" + newkey] = momenta["v" + newkey]
-                    # prev_momenta_squared["m" + newkey] = momenta_squared["m" + newkey]
-                     
-                grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-
-                if step%100 == 0:
-                    train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
-                    step_data[(epoch, step)] = [train_loss, train_err, valid_loss, val_err, eta]
-
+        # saved parameters are cast to the requested dtype, older pickles are float64
+        return flatten(load_params(path_save_dir, state), dtype)[1]
+
+def train(X, Y, X_val, Y_val, optimizer, activation_func, loss_func, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
+ inputsize = 784, outputsize = 10, anneal = True, eval_mode = "full", eval_every = 100, eval_subsample = 5000, eval_chunk = 10000,
+ loader = None, should_stop = None, keep_checkpoints = 2, checkpoint_every = None, resume = False, sampler = None,
+ max_anneals = 10):
+    # The minibatches are gathered from X and Y in the order of sampler, by default the file order. With a MinibatchLoader 
+    # they are streamed from it instead, in the order of its sampler.
+    # should_stop(epoch, valid_loss) is called after every kept epoch, the training ends early when it returns True.
+    # The training also ends, at the last kept epoch, after max_anneals rollbacks in a row. Otherwise a run whose 
+    # validation loss never improves again halves eta until it underflows and never returns, and never reaches the next
+    # rung of a halving sweep either.
+    # The full training state is checkpointed after every epoch and every checkpoint_every steps, with resume = True 
+    # the training goes on from the checkpoint in path_save_dir if there is one
+    step_data = {}
+    epoch_data = []
+    params = optimizer.params
+    # the last kept epoch, for anneal rollbacks, see CheckpointManager
+    checkpoints = CheckpointManager(optimizer, path_save_dir, keep_checkpoints)
+
+    # see measure_training for the meaning of eval_mode
+    running = np.zeros(3)
+    X_eval, Y_eval = None, None
+    if eval_mode == "subsample":
+        X_eval, Y_eval = create_eval_subsample(X, Y, eval_subsample)
+
+    if loader is not None:
+        sampler = loader.sampler
+    elif sampler is None:
+        sampler = Sampler(np.shape(X)[1], batch_size, shuffle = False)
+    # a checkpoint is only resumed by a run with the same settings, see CheckpointManager
+    checkpoints.settings = {"activation_func": activation_func, "loss_func": loss_func, "batch_size": batch_size, 
+        "sampler": [type(sampler).__name__, sampler.shuffle, sampler.num_examples]}
+
+    epoch, start_step = 0, 0
+    if resume and os.path.exists(checkpoints.path_state):
+        epoch, start_step, step_data, epoch_data = checkpoints.restore_state(running, sampler)
+        print("resuming at epoch " + str(epoch) + ", step " + str(start_step))
+        if epoch >= num_epochs:
+            print("the checkpoint in " + path_save_dir + " is of a finished run, there is nothing left to train")
 
-        train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
+    while epoch < num_epochs:
+        step = start_step
+        start_step = 0
+
+        # iterate through the data one minibatch at a time, one column per example
+        sampler.skip = step
+        if loader is None:
+            batches = gather_batches(X, Y, sampler)
+        else:
+            batches = loader
+        for x, y in batches:
+            # perform forward pass and getting a prediction for the whole batch. For cross entropy the batch loss and its 
+            # gradient at the output layer come out of the forward pass
+            if loss_func == "ce":
+                yhat, A, H, batch_loss, da = forward_pass(x, params, activation_func, num_hidden, y)
+            else:
+                yhat, A, H = forward_pass(x, params, activation_func, num_hidden)
+                batch_loss, da = None, None
+            if eval_mode == "running":
+                if batch_loss is None:
+                    batch_correct, batch_loss = batch_metrics(yhat, y, loss_func)
+                else:
+                    batch_correct = count_correct(yhat, y)
+                running += [batch_correct, batch_loss, np.shape(x)[1]]
+            # performing back propagation, the gradients summed over the batch are written into the optimizer's buffer
+            optimizer.zero()
+            back_prop(H, A, params, num_hidden, sizes, y, yhat, loss_func, activation_func, inputsize, outputsize, optimizer.grads, da)
+            # update all the parameters at once. The last batch can be smaller than batch_size
+            optimizer.step(np.shape(x)[1])
+
+            # one step(batch) is done, so update step
+            step = step + 1
+            # store data for log files every eval_every steps
+            if step%eval_every == 0:
+                train_err, train_loss = measure_training(X, Y, params, activation_func, num_hidden, loss_func, eval_mode, running, X_eval, Y_eval, eval_chunk)
+                val_err, valid_loss = evaluate(X_val, Y_val, params, activation_func, num_hidden, loss_func, eval_chunk)
+                step_data[(epoch, step)] = [train_loss, train_err, valid_loss, val_err, optimizer.eta]
+            if checkpoint_every is not None and step%checkpoint_every == 0:
+                checkpoints.save_state(epoch, step, step_data, epoch_data, running, sampler)
+
+        train_err, train_loss = measure_training(X, Y, params, activation_func, num_hidden, loss_func, eval_mode, running, X_eval, Y_eval, eval_chunk)
+        val_err, valid_loss = evaluate(X_val, Y_val, params, activation_func, num_hidden, loss_func, eval_chunk)
 
+        # Start anneling learning rate if the validation loss of the previous epoch is less than the current epoch
         if anneal and epoch >=1 and epoch_data[epoch - 1][2] <= valid_loss:
-            eta = eta/2
-            params = load_params(path_save_dir, epoch - 1)
+            checkpoints.restore()
+            if checkpoints.anneals > max_anneals:
+                print("stopped after " + str(max_anneals) + " anneals without improvement")
+                break
+            optimizer.eta = optimizer.eta/2
             epoch = epoch - 1
             print("anneal")
         else: 
             display_info(epoch, train_err, train_loss, val_err, valid_loss)
             epoch_data.append([epoch, train_loss, valid_loss])
-            pickle_params(params, epoch, path_save_dir)
+            checkpoints.save(epoch)
+            if should_stop is not None and should_stop(epoch, valid_loss):
+                print("stopped early after epoch " + str(epoch))
+                break
 
         epoch = epoch + 1
+        checkpoints.save_state(epoch, 0, step_data, epoch_data, running, sampler)
+    checkpoints.close()
     return params, step_data, epoch_data
 
+"""# Function for Adam"""
+
+def adam(X, Y, X_val, Y_val, activation_func, loss_func, eta, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
+ inputsize = 784, outputsize = 10, beta1 = 0.9, beta2 = 0.999, eps = 1e-8, anneal = True, pretrain = False, state = 0):
+    print("Adam optimizer is being used.")
+    params = init_params(num_hidden, activation_func, sizes, path_save_dir, inputsize, outputsize, pretrain, state)
+    optimizer = AdamOptimizer(params, eta, beta1, beta2, eps)
+    return train(X, Y, X_val, Y_val, optimizer, activation_func, loss_func, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
+        inputsize, outputsize, anneal)
+
 """# Function for Momentum GD"""
 
 def mgd(X, Y, X_val, Y_val, activation_func, loss_func, eta, gamma, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
  inputsize = 784, outputsize = 10, anneal = True, pretrain = False, state = 0):
     print("momentum gradient descent")
-    step_data = {}
-    epoch_data = []
-
-    if pretrain == False:
-        params = createnetwork(num_hidden, activation_func, sizes, inputsize, outputsize)
-    elif pretrain == True:
-        params = load_params(path_save_dir, state)
-
-    prev_momenta = createmomenta(num_hidden, sizes, inputsize, outputsize)
-    momenta = createmomenta(num_hidden, sizes, inputsize, outputsize)
-    pointsseen = 0
-
-    epoch = 0
-    while epoch < num_epochs:
-        grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-        step = 0
-        for j in range(0, 55000):
-            x = X[:,j]
-            y = Y[:,j]
-            yhat, A, H = forward_pass(x, params, activation_func, num_hidden)
-            grad_current = back_prop(H, A, params, num_hidden, sizes, y, yhat, loss_func, activation_func, inputsize, outputsize)
-            for key in grads:
-                grads[key] = grads[key] + grad_current[key]
-            pointsseen = pointsseen + 1
-
-            if pointsseen% batch_size == 0:
-                for newkey in params:
-                    momenta["v" + newkey] = gamma*prev_momenta["v" + newkey] + eta*grads["d" + newkey]
-                    params[newkey] = params[newkey] - momenta["v" + newkey]
-                    prev_momenta["v" + newkey] = momenta["v" + newkey] 
-                grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-
-                step = step + 1
-                if step%100 == 0:
-                    train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
-                    step_data[(epoch, step)] = [train_loss, train_err, valid_loss, val_err, eta]
-       
-        train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
-        
-        if anneal and epoch >=1 and epoch_data[epoch - 1][2] <= valid_loss:
-            eta = eta/2
-            params = load_params(path_save_dir, epoch - 1)
-            epoch = epoch - 1
-        else: 
-            display_info(epoch, train_err, train_loss, val_err, valid_loss)
-            epoch_data.append([epoch, train_loss, valid_loss])
-            pickle_params(params, epoch, path_save_dir)
-
-        epoch = epoch + 1
-
-    return params, step_data, epoch_data
+    params = init_params(num_hidden, activation_func, sizes, path_save_dir, inputsize, outputsize, pretrain, state)
+    optimizer = MomentumOptimizer(params, eta, gamma)
+    return train(X, Y, X_val, Y_val, optimizer, activation_func, loss_func, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
+        inputsize, outputsize, anneal)
 
 """# Function for SGD"""
 
 def sgd(X, Y, X_val, Y_val, activation_func, loss_func, eta, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
  inputsize = 784, outputsize = 10, anneal = True, pretrain = False, state = 0):
     print("Gradient decent with minibatch is used.")
-    step_data = {}
-    epoch_data = []
-    
-    if pretrain == False:
-        params = createnetwork(num_hidden, activation_func, sizes, inputsize, outputsize)
-    elif pretrain == True:
-        params = load_params(path_save_dir, state)
-
-
-    pointsseen = 0
-    epoch = 0
-    while epoch < num_epochs:
-        # creation of zero grad vectors at the start of every epoch
-        grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-        step = 0
-
-        # iterate through every data point
-        for j in range(0, 55000):
-            x = X[:,j]
-            y = Y[:,j]
-            
-            # perform forward pass and getting a prediction 
-            yhat, A, H = forward_pass(x, params, activation_func, num_hidden)
-            # performing back propagation and generating new gradients
-            grad_current = back_prop(H, A, params, num_hidden, sizes, y, yhat, loss_func, activation_func, inputsize, outputsize)
-            # cumulating the gradient values
-            for key in grads:
-                grads[key] = grads[key] + grad_current[key]
-
-            pointsseen = pointsseen + 1
-
-            # Check if a batch is complete. If so, then perform GD, update the parameters and initialize new gradients
-            if pointsseen % batch_size == 0:
-                for newkey in params:
-                    params[newkey] = params[newkey] - eta*(grads["d" + newkey]/batch_size) 
-                grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-
-                # entering the if implies one step(batch) is done, so update step
-                step = step + 1
-                # store data for log files if 100 steps are done
-                if step%100 == 0:
-                    train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
-                    step_data[(epoch, step)] = [train_loss, train_err, valid_loss, val_err, eta]
-
-        train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
-
-        # Start anneling learning rate if the validation loss of the previous epoch is less than the current epoch
-        if anneal and epoch >=1 and epoch_data[epoch - 1][2] <= valid_loss:
-            eta = eta/2
-            params = load_params(path_save_dir, epoch - 1)
-            epoch = epoch - 1
-        else: 
-            display_info(epoch, train_err, train_loss, val_err, valid_loss)
-            epoch_data.append([epoch, train_loss, valid_loss])
-            pickle_params(params, epoch, path_save_dir)
-
-        epoch = epoch + 1
-    return params, step_data, epoch_data
+    params = init_params(num_hidden, activation_func, sizes, path_save_dir, inputsize, outputsize, pretrain, state)
+    optimizer = SGDOptimizer(params, eta)
+    return train(X, Y, X_val, Y_val, optimizer, activation_func, loss_func, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
+        inputsize, outputsize, anneal)
 
 """# Function for NAG"""
 
 def nag(X, Y, X_val, Y_val, activation_func, loss_func, eta, gamma, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
  inputsize = 784, outputsize = 10, anneal = True, pretrain = False, state = 0):
     print("NAG")
-    step_data = {}
-    epoch_data = []
-
-    if pretrain == False:
-        params = createnetwork(num_hidden, activation_func, sizes, inputsize, outputsize)
-    elif pretrain == True:
-        params = load_params(path_save_dir, state)
-
-    prev_momenta = createmomenta(num_hidden, sizes, inputsize, outputsize)
-    momenta = createmomenta(num_hidden, sizes, inputsize, outputsize)
-
-    pointsseen = 0
-    epoch = 0
-    while epoch < (num_epochs):
-        grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-        step = 0
-        for j in range(0, 55000):
-            x = X[:,j]
-            y = Y[:,j]
-            yhat, A, H = forward_pass(x, params, activation_func, num_hidden)
-            grad_current = back_prop(H, A, params, num_hidden, sizes, y, yhat, loss_func, activation_func, inputsize, outputsize)
-            for key in grads:
-                grads[key] = grads[key] + grad_current[key]
-            pointsseen = pointsseen + 1
-            if pointsseen% batch_size == 0:
-                step = step + 1
-
-                for newkey in params:
-                    momenta["v" + newkey] = gamma*prev_momenta["v" + newkey] + eta*grads["d" + newkey]
-                    params[newkey] = params[newkey] - momenta["v" + newkey]
-                    prev_momenta["v" + newkey] = momenta["v" + newkey] 
-                grads = creategrads(num_hidden, sizes, inputsize, outputsize)
-
-                if step%100 == 0:
-                    train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
-                    step_data[(epoch, step)] = [train_loss, train_err, valid_loss, val_err, eta]
-
-                for next_key in params:
-                    # Try to place this in the above for loop------------------------------------------------------------------------------------------------------------------
-                    momenta["v" + next_key] = gamma*prev_momenta["v" + next_key]
-                    params[next_key] = params[next_key] - momenta["v" + next_key]
-
-        train_err, train_loss, val_err, valid_loss = measure_performance(X, Y, X_val, Y_val, params, activation_func, num_hidden, loss_func)
-
-        if anneal and epoch >=1 and epoch_data[epoch - 1][2] <= valid_loss:
-            eta = eta/2
-            params = load_params(path_save_dir, epoch - 1)
-            epoch = epoch - 1
-            print("anneal")
-        else: 
-            display_info(epoch, train_err, train_loss, val_err, valid_loss)
-            epoch_data.append([epoch, train_loss, valid_loss])
-            pickle_params(params, epoch, path_save_dir)
-
-
-        epoch = epoch + 1
-    return params, step_data, epoch_data
+    params = init_params(num_hidden, activation_func, sizes, path_save_dir, inputsize, outputsize, pretrain, state)
+    optimizer = NAGOptimizer(params, eta, gamma)
+    return train(X, Y, X_val, Y_val, optimizer, activation_func, loss_func, num_epochs, num_hidden, sizes, batch_size, path_save_dir,
+        inputsize, outputsize, anneal)
+
+"""# Cached PCA preprocessing"""
+
+# The PCA projection is fitted on the training pixels/255. The fitted projection (components and mean) and the projected 
+# float32 arrays are stored in cache_dir, keyed by the hash of the training CSV, the number of components and the solver, 
+# so repeated run_model calls on the same data skip both the fit and the transform. pca_solver is "auto", "full" or 
+# "randomized" for sklearn's PCA, or "incremental" for IncrementalPCA, which fits in chunks of batch_size rows and never 
+# needs the whole training matrix as float64 at once.
+
+def fit_pca(X, n_components, pca_solver = "auto", batch_size = 10000):
+    # X has one row per example
+    from sklearn.decomposition import IncrementalPCA, PCA
+    if pca_solver == "incremental":
+        pca = IncrementalPCA(n_components = n_components)
+        for j in range(0, np.shape(X)[0], batch_size):
+            pca.partial_fit(X[j:j + batch_size]/255)
+    else:
+        pca = PCA(n_components = n_components, svd_solver = pca_solver)
+        pca.fit(X/255)
+    return pca.components_, pca.mean_
+
+def project(X, components, mean, chunk_size = 10000):
+    # Same as PCA.transform of X/255, one row per example, computed in chunks into a float32 array
+    projected = np.empty((np.shape(X)[0], np.shape(components)[0]), dtype = np.float32)
+    for j in range(0, np.shape(X)[0], chunk_size):
+        projected[j:j + chunk_size] = np.dot(X[j:j + chunk_size]/255 - mean, components.T)
+    return projected
+
+def load_pca(path_train, n_components = 50, pca_solver = "auto", cache_dir = None):
+    if cache_dir is None:
+        cache_dir = Path(path_train).parent / "npy_cache"
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents = True, exist_ok = True)
+    key = "pca" + str(n_components) + "_" + pca_solver + "_" + file_hash(path_train)[:16]
+    path_pca = cache_dir / (key + ".npz")
+    if path_pca.exists():
+        with np.load(path_pca) as fitted:
+            return fitted["components"], fitted["mean"], key
+    data, _, _ = read_data(path_train, cache_dir)
+    components, mean = fit_pca(data, n_components, pca_solver)
+    tmp_path = str(path_pca) + ".tmp"
+    with open(tmp_path, 'wb') as handle:
+        np.savez(handle, components = components, mean = mean)
+    os.replace(tmp_path, path_pca)
+    return components, mean, key
+
+def load_projected(path_to_csv, labelled, components, mean, key, cache_dir = None):
+    # Returns the projected data of a CSV with one column per example, read from the cache when possible
+    if cache_dir is None:
+        cache_dir = Path(path_to_csv).parent / "npy_cache"
+    path_projected = Path(cache_dir) / (Path(path_to_csv).stem + "_" + file_hash(path_to_csv)[:16] + "_" + key + ".npy")
+    if not path_projected.exists():
+        if labelled:
+            data, _, _ = read_data(path_to_csv, cache_dir)
+        else:
+            data, _, _ = read_data_test(path_to_csv, cache_dir)
+        save_npy(path_projected, project(data, components, mean))
+    return np.load(path_projected, mmap_mode = "r").T
 
 """# Function for reading train validation and test data"""
 
 # Read train, validation and test data
-def init_data(path_train, path_val, path_test):
-    data, X, y = read_data(path_train)
-    
+def init_data(path_train, path_val, path_test, cache_dir = None, n_components = 50, pca_solver = "auto"):
+    components, mean, key = load_pca(path_train, n_components, pca_solver, cache_dir)
+
+    data, _, y = read_data(path_train, cache_dir)
     Y = (convert_to_onehot(y, 10)).T
-    X = (X.T/255)
-    pca = PCA(n_components=50)
-    pca.fit(X)
-    X = pca.transform(X)
-    X = X.T
+    X = load_projected(path_train, True, components, mean, key, cache_dir)
     print(np.shape(X), np.shape(y), np.shape(data))
 
-    data, X_val, y_val = read_data(path_val)
-    
+    data, _, y_val = read_data(path_val, cache_dir)
     Y_val = (convert_to_onehot(y_val, 10)).T
-    X_val = (X_val.T/255)
-    X_val = pca.transform(X_val)
-    X_val = X_val.T
+    X_val = load_projected(path_val, True, components, mean, key, cache_dir)
     print(np.shape(X_val), np.shape(y_val), np.shape(data))
 
-
-    data, X_test, indices = read_data_test(path_test)
-
-    X_test = X_test.T/255
-    X_test = pca.transform(X_test)
-    X_test = X_test.T
-    #print(np.shape(X_test), "shape of test data")
-    #np.savetxt("test_2.csv",X_test, delimiter = ",")
+    data, _, indices = read_data_test(path_test, cache_dir)
+    X_test = load_projected(path_test, False, components, mean, key, cache_dir)
 
     return X, Y, X_val, Y_val, X_test, indices
 
 
 def pickle_params(params, epoch, path_save_dir):
-    try:
-        os.mkdir(path_save_dir)
-        print("save_dir created at " + path_save_dir)
-    except FileExistsError:
-        print("save_dir already exists at " + path_save_dir)
+    os.makedirs(path_save_dir, exist_ok = True)
     filename = path_save_dir + "weights_" + str(epoch) + ".pickle"    
-    with open(filename, 'wb') as handle:
+    # written to a temporary file first so that a crash never leaves a truncated pickle behind
+    with open(filename + ".tmp", 'wb') as handle:
         pickle.dump(params, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + ".tmp", filename)
 
 def load_params(path_save_dir, epoch):
     if os.path.isdir(path_save_dir):
@@ -640,43 +1134,228 @@ def load_params(path_save_dir, epoch):
     else:
         print("No directory at " + path_save_dir)
 
+"""# Batch inference server"""
+
+# A local HTTP service that loads a set of saved weights once and keeps them in memory. Requests that arrive at the same 
+# time are coalesced by a MicroBatcher into one (features, batch) block, so forward_inference runs once per micro-batch 
+# instead of once per request. The inputs must already be in the input space of the model (after the /255 and PCA of 
+# init_data).
+#   POST /predict  {"inputs": [[x1, x2, ...], ...]}, one row per example -> {"classes": [...], "probs": [[...], ...]}
+#   GET  /stats    request, batch and latency statistics
+# The server is started from the command line with --serve, see main.
+
+class MicroBatcher:
+    def __init__(self, params, activation_func, num_hidden, max_batch = 256, max_delay = 0.0005):
+        # max_batch is the largest number of examples scored together and max_delay the longest time in seconds the 
+        # first request of a micro-batch waits for others to join it
+        self.params = params
+        self.activation_func = activation_func
+        self.num_hidden = num_hidden
+        self.inputsize = np.shape(params["W1"])[1]
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen = 10000)
+        self.counts = {"requests": 0, "examples": 0, "batches": 0}
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def predict(self, x):
+        # x has shape (features, n). Blocks until the micro-batch that contains x has been scored and returns its 
+        # (outputsize, n) softmax outputs.
+        item = {"x": x, "done": threading.Event(), "yhat": None, "error": None, "start": time.perf_counter()}
+        self.requests.put(item)
+        item["done"].wait()
+        if item["error"] is not None:
+            raise item["error"]
+        return item["yhat"]
+
+    def run(self):
+        while True:
+            items = [self.requests.get()]
+            if items[0] is None:
+                return
+            width = np.shape(items[0]["x"])[1]
+            deadline = time.perf_counter() + self.max_delay
+            while width < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout = timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)
+                    break
+                items.append(item)
+                width = width + np.shape(item["x"])[1]
+            self.score(items, width)
+
+    def score(self, items, width):
+        try:
+            X = np.concatenate([item["x"] for item in items], axis = 1)
+            Yhat = forward_inference(X, self.params, self.activation_func, self.num_hidden, chunk_size = width)
+        except Exception as error:
+            for item in items:
+                item["error"] = error
+                item["done"].set()
+            return
+        j = 0
+        end = time.perf_counter()
+        with self.lock:
+            for item in items:
+                m = np.shape(item["x"])[1]
+                item["yhat"] = Yhat[:,j:j + m]
+                j = j + m
+                self.latencies.append(end - item["start"])
+            self.counts["requests"] = self.counts["requests"] + len(items)
+            self.counts["examples"] = self.counts["examples"] + width
+            self.counts["batches"] = self.counts["batches"] + 1
+        for item in items:
+            item["done"].set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stats = dict(self.counts)
+        elapsed = time.perf_counter() - self.started
+        stats["mean_batch_size"] = stats["examples"]/max(stats["batches"], 1)
+        stats["examples_per_second"] = stats["examples"]/elapsed
+        if len(latencies) > 0:
+            stats["latency_ms_mean"] = 1000*float(np.mean(latencies))
+            stats["latency_ms_p50"] = 1000*float(np.percentile(latencies, 50))
+            stats["latency_ms_p99"] = 1000*float(np.percentile(latencies, 99))
+        return stats
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+def make_handler(batcher):
+    from http.server import BaseHTTPRequestHandler
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+        # keep-alive connections avoid a TCP handshake per request
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.send_json(200, batcher.stats())
+            else:
+                self.send_json(404, {"error": "unknown path " + self.path})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            if self.path != "/predict":
+                self.send_json(404, {"error": "unknown path " + self.path})
+                return
+            try:
+                x = np.asarray(json.loads(body)["inputs"], dtype = float)
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_json(400, {"error": "bad request: " + str(error)})
+                return
+            if x.ndim == 1:
+                x = x[np.newaxis, :]
+            if x.ndim != 2 or np.shape(x)[1] != batcher.inputsize:
+                self.send_json(400, {"error": "expected rows of " + str(batcher.inputsize) + " features"})
+                return
+            if not np.all(np.isfinite(x)):
+                # NaN and inf would be scored and come back as bare NaN tokens, which are not JSON
+                self.send_json(400, {"error": "inputs must be finite numbers"})
+                return
+            try:
+                yhat = batcher.predict(np.ascontiguousarray(x.T))
+            except Exception as error:
+                # the error of the whole micro-batch, the connection stays usable
+                self.send_json(500, {"error": "prediction failed: " + str(error)})
+                return
+            self.send_json(200, {"classes": np.argmax(yhat, axis = 0).tolist(), "probs": yhat.T.tolist()})
+
+        def log_message(self, format, *args):
+            # per request logging would dominate the latency
+            pass
+
+    return InferenceHandler
+
+def create_server(path_save_dir, state, activation_func = "relu", host = "127.0.0.1", port = 8000, max_batch = 256, max_delay = 0.0005):
+    from http.server import ThreadingHTTPServer
+
+    class InferenceServer(ThreadingHTTPServer):
+        # the listen backlog of socketserver is 5, which resets connections when many clients connect at once, before 
+        # the accept loop gets to them
+        request_queue_size = 128
+
+    params = load_params(path_save_dir, state)
+    num_hidden = int(len(params.keys())/2 - 1)
+    batcher = MicroBatcher(params, activation_func, num_hidden, max_batch, max_delay)
+    server = InferenceServer((host, port), make_handler(batcher))
+    return server, batcher
+
+def serve(path_save_dir, state, activation_func = "relu", host = "127.0.0.1", port = 8000, max_batch = 256, max_delay = 0.0005):
+    server, batcher = create_server(path_save_dir, state, activation_func, host, port, max_batch, max_delay)
+    print("Serving weights_" + str(state) + " from " + path_save_dir + " at http://" + host + ":" + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        batcher.close()
+
 """# Using all the above functions wih different test cases"""
 
 from pathlib import Path
 # setting variables globally 
-train = Path('/content/train.csv')
-val = Path('/content/valid.csv')
-test = Path('/content/test.csv')
+# (the CSV paths are not called train, val and test because train is the training loop)
 save_dir= '/content/save_dir'
 expt_dir= '/content/expt_dir'
+# every sweep below writes its runs to its own folder in here, see run_sweep
+path_sweep_dir = '/content/sweeps'
 
 path_save_dir = save_dir
 path_expt_dir = expt_dir
-path_train = train
-path_val = val
-path_test = test
+path_train = Path('/content/train.csv')
+path_val = Path('/content/valid.csv')
+path_test = Path('/content/test.csv')
 pretrain = False
 testing = False
 
-def run_model(eta, gamma, num_hidden, sizes, activation_func, loss_func, optim, batch_size, num_epochs, path_save_dir, path_expt_dir, path_train, path_val, path_test, anneal, state):
-  # Reading data
-  if testing == False:
+def run_model(eta, gamma, num_hidden, sizes, activation_func, loss_func, optim, batch_size, num_epochs, path_save_dir, path_expt_dir, path_train, path_val, path_test, anneal, state,
+  eval_mode = "full", eval_every = 100, prefetch = 0, dtype = np.float32, master_weights = False, data = None,
+  should_stop = None, checkpoint_every = None, resume = False, sampling = "shuffle"):
+  # Reading data. data can hold the output of init_data when it has already been read, as in run_sweep
+  if testing == False and data is not None:
+      X, Y, X_val, Y_val, X_test, indices = data
+  elif testing == False:
       X, Y, X_val, Y_val, X_test, indices = init_data(path_train, path_val, path_test)
   elif testing == True:
+      import pandas as pd
       data = pd.read_csv(path_test, header = None)
       X_test = data.to_numpy()
       indices = np.arange(np.shape(data)[1])
 
   # Training part
   if testing == False:
-      if optim == "gd":
-          params, step_data, epoch_data = sgd(X, Y, X_val, Y_val, activation_func, loss_func, eta, num_epochs, num_hidden, sizes, batch_size, path_save_dir, inputsize = np.shape(X)[0], anneal = anneal, pretrain = pretrain, state = state)
-      elif optim == "momentum":
-          params, step_data, epoch_data = mgd(X, Y, X_val, Y_val, activation_func, loss_func, eta, gamma, num_epochs, num_hidden, sizes, batch_size, path_save_dir, inputsize = np.shape(X)[0], anneal = anneal, pretrain = pretrain, state = state)
-      elif optim == "adam":
-          params, step_data, epoch_data = adam(X, Y, X_val, Y_val, activation_func, loss_func, eta, num_epochs, num_hidden, sizes, batch_size, path_save_dir, inputsize = np.shape(X)[0], anneal = anneal, pretrain = pretrain, state = state)
-      elif optim == "nag":
-          params, step_data, epoch_data = nag(X, Y, X_val, Y_val, activation_func, loss_func, eta, gamma, num_epochs, num_hidden, sizes, batch_size, path_save_dir, inputsize = np.shape(X)[0], anneal = anneal, pretrain = pretrain, state = state)
+      # float32 parameters by default, master_weights keeps float64 copies of them in the optimizer
+      params = init_params(num_hidden, activation_func, sizes, path_save_dir, np.shape(X)[0], pretrain = pretrain, state = state, dtype = dtype)
+      optimizer = create_optimizer(optim, params, eta, gamma, master_weights = master_weights)
+      # sampling is "sequential", "shuffle" or "stratified", see create_sampler. With prefetch > 0 the minibatches are 
+      # streamed from the cached arrays by a background thread
+      sampler = create_sampler(sampling, Y, batch_size)
+      loader = MinibatchLoader(X.T, Y.T, batch_size, prefetch = prefetch, sampler = sampler) if prefetch > 0 else None
+      params, step_data, epoch_data = train(X, Y, X_val, Y_val, optimizer, activation_func, loss_func, num_epochs, num_hidden, sizes, batch_size, path_save_dir, inputsize = np.shape(X)[0], anneal = anneal,
+          eval_mode = eval_mode, eval_every = eval_every, loader = loader, should_stop = should_stop,
+          checkpoint_every = checkpoint_every, resume = resume, sampler = sampler)
      
       # Testing part
       create_log_files(path_expt_dir, step_data)
@@ -693,152 +1372,352 @@ def run_model(eta, gamma, num_hidden, sizes, activation_func, loss_func, optim,
   create_submission(X_test, indices, params, activation_func, num_hidden, submission_path)
   return epoch_data
 
-def plot_stuff(result_list, color_list, description_list, title):
-  plt.figure(figsize=(10,8))
-  for i in range(0,len(result_list)): 
-    color = color_list[i]
-    des = description_list[i]
-    epoch_data = result_list[i]
-    epoch_data_np = np.asarray(epoch_data)
-    plt.plot(epoch_data_np.T[0], epoch_data_np.T[1], color,label=des)  
-  
-  plt.xlabel("Number of Iterations")
-  plt.ylabel("Loss values")
-  plt.grid()
-  plt.title(title[0])
-  plt.legend()
-  plt.show()  
-
-  plt.figure(figsize=(10,8))
+"""# Parallel sweeps"""
+
+# run_sweep trains a list of run_model configurations on a pool of worker processes. The data is read once by the parent 
+# with init_data and copied into shared memory blocks that every worker maps read-only, so a worker costs no extra copy 
+# of the dataset. Every run gets its own save_dir and expt_dir under path_root, so runs cannot overwrite each other's 
+# weights, logs or submissions. Each worker is limited to blas_threads BLAS threads so that the pool does not 
+# oversubscribe the CPU. The epoch_data of the runs is returned in the order of the configurations and pickled to 
+# path_root/results.pickle.
+# The workers are spawned, not forked: importing this file has no side effects, and a fork while another thread of the 
+# parent (a BackgroundWriter, a MinibatchLoader) holds a lock can leave the child deadlocked. The workers only see the
+# module level settings as they are in the file.
+#
+# With halving = True the sweep is an asynchronous successive halving search. The validation loss of every run is 
+# recorded at the rungs, after min_epochs, min_epochs*reduction, min_epochs*reduction^2, ... epochs. A run that is not 
+# among the best 1/reduction of the losses recorded at a rung so far is stopped there and its worker moves on to the next 
+# configuration, so most of the epochs go to the promising configurations. Stopped runs return a shorter epoch_data.
+# Cross entropy and squared error losses are on different scales, so the runs are only ranked against the runs with the
+# same loss_func: every loss function has its own rungs.
+
+sweep_defaults = {"eta": 0.005, "gamma": 0.5, "anneal": True, "state": 0}
+sweep_data = None
+sweep_rungs = None
+
+def sweep_grid(**axes):
+    # sweep_grid(optim = ["adam", "nag"], batch_size = [20, 100]) gives the 4 combinations as configuration dictionaries
+    keys = list(axes.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[axes[key] for key in keys])]
+
+def run_name(i, config):
+    sizes = "x".join([str(size) for size in config.get("sizes", [])])
+    return "%03d_%s_%s_%s_%s_b%s" % (i, config.get("optim"), config.get("activation_func"), config.get("loss_func"), sizes,
+        config.get("batch_size"))
+
+def share_arrays(arrays):
+    # Copies the arrays into shared memory. Arrays with one column per example are transposed views of row major data, 
+    # so they are stored row major and transposed back by attach_arrays.
+    blocks, descriptors = [], []
+    for array in arrays:
+        array = np.asarray(array)
+        transposed = array.ndim == 2 and not array.flags["C_CONTIGUOUS"] and array.flags["F_CONTIGUOUS"]
+        stored = array.T if transposed else array
+        block = shared_memory.SharedMemory(create = True, size = max(stored.nbytes, 1))
+        np.ndarray(np.shape(stored), dtype = stored.dtype, buffer = block.buf)[...] = stored
+        blocks.append(block)
+        descriptors.append((block.name, np.shape(stored), stored.dtype.str, transposed))
+    return blocks, descriptors
+
+def attach_arrays(descriptors):
+    blocks, arrays = [], []
+    for name, shape, dtype, transposed in descriptors:
+        block = shared_memory.SharedMemory(name = name)
+        array = np.ndarray(shape, dtype = dtype, buffer = block.buf)
+        array.flags.writeable = False
+        blocks.append(block)
+        arrays.append(array.T if transposed else array)
+    return blocks, arrays
+
+def limit_blas_threads(num_threads):
+    for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[var] = str(num_threads)
+    # the variables are only read when BLAS is loaded, which has already happened in the worker, so it is also limited at 
+    # runtime
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        print("threadpoolctl is not installed, BLAS threads are not limited")
+        return
+    threadpool_limits(num_threads)
+
+def init_sweep_worker(descriptors, blas_threads, rungs):
+    global sweep_data, sweep_rungs
+    limit_blas_threads(blas_threads)
+    # the blocks are kept with the arrays, the arrays are only valid while their blocks are open
+    sweep_data = attach_arrays(descriptors)
+    sweep_rungs = rungs
+
+def create_rungs(num_epochs, min_epochs, reduction, loss_funcs, manager = None):
+    # One list of validation losses per loss function and rung, keyed by (loss_func, the number of epochs after which it 
+    # is recorded). With a manager the lists and the lock are shared by all the workers of the pool.
+    rungs = {}
+    for loss_func in loss_funcs:
+        epochs = min_epochs
+        while epochs < num_epochs:
+            rungs[(loss_func, epochs)] = manager.list() if manager is not None else []
+            epochs = epochs*reduction
+    lock = manager.Lock() if manager is not None else threading.Lock()
+    return rungs, lock, reduction
+
+def halving_rule(loss_func, epoch, valid_loss):
+    rungs, lock, reduction = sweep_rungs
+    rung = (loss_func, epoch + 1)
+    if rung not in rungs:
+        return False
+    with lock:
+        rungs[rung].append(valid_loss)
+        cutoff = np.quantile(np.asarray(rungs[rung][:]), 1/reduction)
+    return valid_loss > cutoff
+
+def run_sweep_config(job):
+    path_run, config = job
+    path_save_dir = os.path.join(path_run, "save_dir") + os.sep
+    path_expt_dir = os.path.join(path_run, "expt_dir") + os.sep
+    os.makedirs(path_save_dir, exist_ok = True)
+    os.makedirs(path_expt_dir, exist_ok = True)
+    kwargs = dict(sweep_defaults)
+    kwargs.update(config)
+    should_stop = functools.partial(halving_rule, kwargs["loss_func"]) if sweep_rungs is not None else None
+    return run_model(path_save_dir = path_save_dir, path_expt_dir = path_expt_dir, path_train = None, path_val = None, 
+        path_test = None, data = sweep_data[1], should_stop = should_stop, **kwargs)
+
+def run_sweep(configs, path_train, path_val, path_test, path_root, processes = None, blas_threads = 1, halving = False, 
+ min_epochs = 1, reduction = 3):
+    configs = list(configs)
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1)//blas_threads)
+    processes = min(processes, len(configs))
+    jobs = [(os.path.join(path_root, run_name(i, config)), config) for i, config in enumerate(configs)]
+
+    global sweep_data, sweep_rungs
+    data = init_data(path_train, path_val, path_test)
+    num_epochs = max([dict(sweep_defaults, **config)["num_epochs"] for config in configs])
+    loss_funcs = sorted(set([dict(sweep_defaults, **config)["loss_func"] for config in configs]))
+    if processes <= 1:
+        sweep_data = (None, data)
+        sweep_rungs = create_rungs(num_epochs, min_epochs, reduction, loss_funcs) if halving else None
+        results = [run_sweep_config(job) for job in jobs]
+    else:
+        blocks, descriptors = share_arrays(data)
+        context = multiprocessing.get_context("spawn")
+        manager = context.Manager() if halving else None
+        try:
+            rungs = create_rungs(num_epochs, min_epochs, reduction, loss_funcs, manager) if halving else None
+            with context.Pool(processes, initializer = init_sweep_worker, initargs = (descriptors, blas_threads, rungs)) as pool:
+                results = pool.map(run_sweep_config, jobs, chunksize = 1)
+        finally:
+            if manager is not None:
+                manager.shutdown()
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    os.makedirs(path_root, exist_ok = True)
+    with open(os.path.join(path_root, "results.pickle"), 'wb') as handle:
+        pickle.dump({"configs": configs, "runs": [job[0] for job in jobs], "epoch_data": results}, handle, 
+            protocol = pickle.HIGHEST_PROTOCOL)
+    return results
+
+"""# Plots"""
+
+# Plots are drawn on their own Figure with the Agg canvas instead of through pyplot, so no window is opened and they can
+# be rendered by a BackgroundWriter thread.
+
+def save_figure(figure, path):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    FigureCanvasAgg(figure)
+    figure.savefig(path)
+
+def plot_losses(path, result_list, color_list, description_list, column, title):
+  from matplotlib.figure import Figure
+  figure = Figure(figsize=(10,8))
+  axes = figure.add_subplot(1, 1, 1)
   for i in range(0,len(result_list)):
-    color = color_list[i]
-    des = description_list[i]
-    epoch_data = result_list[i]
-    epoch_data_np = np.asarray(epoch_data)
-    plt.plot(epoch_data_np.T[0], epoch_data_np.T[2], color,label=des)
-
-  plt.xlabel("Number of Iterations")
-  plt.ylabel("Loss values")
-  plt.grid()
-  plt.title(title[1])
-  plt.legend()
-  plt.show()  
+    epoch_data_np = np.asarray(result_list[i])
+    axes.plot(epoch_data_np.T[0], epoch_data_np.T[column], color_list[i], label=description_list[i])
+
+  axes.set_xlabel("Number of Iterations")
+  axes.set_ylabel("Loss values")
+  axes.grid()
+  axes.set_title(title)
+  axes.legend()
+  save_figure(figure, path)
+
+# plot_stuff writes the training and the validation loss curves to training_loss.png and validation_loss.png in 
+# path_plot_dir, through writer when one is given.
+
+def plot_stuff(result_list, color_list, description_list, title, path_plot_dir, writer = None):
+  for column, name in [(1, "training_loss.png"), (2, "validation_loss.png")]:
+    args = (os.path.join(path_plot_dir, name), result_list, color_list, description_list, column, title[column - 1])
+    if writer is not None:
+      writer.put(plot_losses, *args)
+    else:
+      plot_losses(*args)
 
   return
 
-"""For all the above 4 cases you will use sigmoid activation, cross entropy loss, Adam,
-batch size 20 and tune the learning rate to get best results. For each of the 4 questions
-above you need to draw the following plots:
-
-# Training and Validation loss for different sizes with two hidden layers
-"""
-
-result_50 = run_model(0.005, 0.5, 2, [50,50], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_100 = run_model(0.005, 0.5, 2, [100,100], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_200 = run_model(0.005, 0.5, 2, [200,200], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_300 = run_model(0.005, 0.5, 2, [300,300], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-
-result_list = [result_50, result_100, result_200, result_300]
-color_list = ['r', 'b', 'g', 'm']
-description_list = ['50 hidden units', '100 hidden units', '200 hidden units', '300 hidden units']
-title = ['Training loss', 'Validation loss']
-
-plot_stuff(result_list, color_list, description_list, title)
-
-"""# Training and Validation loss for different sizes with one hidden layer"""
-
-# # (eta, gamma, num_hidden, sizes, activation_func, loss_func, optim, batch_size, num_epochs, path_save_dir, path_expt_dir, path_train, path_val, path_test, anneal, state)
-result_50_1 = run_model(0.005, 0.5, 1, [50], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_100_1 = run_model(0.005, 0.5, 1, [100], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_200_1 = run_model(0.005, 0.5, 1, [200], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_300_1 = run_model(0.005, 0.5, 1, [300], 'relu', 'ce', 'adam', 20, 10, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-
-result_list = [result_50_1, result_100_1, result_200_1, result_300_1]
-color_list = ['r', 'b', 'g', 'm']
-description_list = ['50 hidden units', '100 hidden units', '200 hidden units', '300 hidden units']
-title = ['Training loss', 'Validation loss']
-
-plot_stuff(result_list, color_list, description_list, title)
-
-"""# Training and Validation loss for different sizes with three hidden layers"""
-
-# # (eta, gamma, num_hidden, sizes, activation_func, loss_func, optim, batch_size, num_epochs, path_save_dir, path_expt_dir, path_train, path_val, path_test, anneal, state)
-result_50_3 = run_model(0.005, 0.5, 3, [50, 50, 50], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_100_3 = run_model(0.005, 0.5, 3, [75, 75, 75], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_200_3 = run_model(0.005, 0.5, 3, [100, 100, 100], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_300_3 = run_model(0.005, 0.5, 3, [125, 125, 125], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-
-result_list = [result_50_3, result_100_3, result_200_3, result_300_3]
-color_list = ['r', 'b', 'g', 'm']
-description_list = ['50 hidden units', '100 hidden units', '200 hidden units', '300 hidden units']
-title = ['Training loss', 'Validation loss']
-
-plot_stuff(result_list, color_list, description_list, title)
-
-"""# Training and Validation loss for different sizes with four hidden layers"""
-
-# # (eta, gamma, num_hidden, sizes, activation_func, loss_func, optim, batch_size, num_epochs, path_save_dir, path_expt_dir, path_train, path_val, path_test, anneal, state)
-result_50_4 = run_model(0.005, 0.5, 4, [50, 50, 50, 50], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_100_4 = run_model(0.005, 0.5, 4, [75, 75, 75, 75], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_200_4 = run_model(0.005, 0.5, 4, [100, 100, 100, 100], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_300_4 = run_model(0.005, 0.5, 4, [125, 125, 125, 125], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-
-result_list = [result_50_4, result_100_4, result_200_4, result_300_4]
-color_list = ['r', 'b', 'g', 'm']
-description_list = ['50 hidden units', '75 hidden units', '100 hidden units', '125 hidden units']
-title = ['Training loss', 'Validation loss']
-
-plot_stuff(result_list, color_list, description_list, title)
-
-"""# Training and Validation loss for different learning algorithms"""
-
-# # (eta, gamma, num_hidden, sizes, activation_func, loss_func, optim, batch_size, num_epochs, path_save_dir, path_expt_dir, path_train, path_val, path_test, anneal, state)
-result_adam = run_model(0.005, 0.5, 2, [50, 50], 'relu', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_nag = run_model(0.005, 0.5, 2, [50, 50], 'relu', 'ce', 'nag', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_mgd = run_model(0.005, 0.5, 2, [50, 50], 'relu', 'ce', 'momentum', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-
-result_list = [result_adam, result_nag, result_mgd]
-color_list = ['r', 'b', 'g']
-description_list = ['Adam', 'Nestrov accelerated GD', 'Momentum GD']
-title = ['Training loss', 'Validation loss']
-
-plot_stuff(result_list, color_list, description_list, title)
+# main runs all the sweeps above and writes their loss curves next to their results in the sweep folder. The paths set
+# above are the defaults of its command line options. With --serve it starts the batch inference server on the weights
+# of epoch --state in --save-dir instead.
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = "Runs the hyperparameter sweeps of the feedforward network")
+    parser.add_argument("--train", type = Path, default = path_train, help = "training CSV")
+    parser.add_argument("--val", type = Path, default = path_val, help = "validation CSV")
+    parser.add_argument("--test", type = Path, default = path_test, help = "test CSV")
+    parser.add_argument("--sweep-dir", default = path_sweep_dir, help = "folder the runs and plots of every sweep are written to")
+    parser.add_argument("--processes", type = int, default = None, help = "number of worker processes, all CPUs by default")
+    parser.add_argument("--blas-threads", type = int, default = 1, help = "BLAS threads per worker")
+    parser.add_argument("--halving", action = "store_true", help = "stop unpromising runs early, see run_sweep")
+    parser.add_argument("--serve", action = "store_true", help = "serve saved weights over HTTP instead of running the sweeps")
+    parser.add_argument("--save-dir", default = path_save_dir, help = "folder of the weights to serve")
+    parser.add_argument("--state", type = int, default = 0, help = "epoch of the weights to serve")
+    parser.add_argument("--activation", default = "relu", help = "activation function of the served network")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8000)
+    parser.add_argument("--max-batch", type = int, default = 256, help = "largest number of examples scored together")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    if args.serve:
+        serve(os.path.join(args.save_dir, ""), args.state, args.activation, args.host, args.port, args.max_batch)
+        return
+    path_train, path_val, path_test, path_sweep_dir = args.train, args.val, args.test, args.sweep_dir
+    options = {"processes": args.processes, "blas_threads": args.blas_threads, "halving": args.halving}
+
+    artifacts = BackgroundWriter()
+
+    # For all the above 4 cases you will use sigmoid activation, cross entropy loss, Adam,
+    # batch size 20 and tune the learning rate to get best results. For each of the 4 questions
+    # above you need to draw the following plots:
+    #
+    # Training and Validation loss for different sizes with two hidden layers
+
+    result_50, result_100, result_200, result_300 = run_sweep([
+        dict(num_hidden = 2, sizes = [50,50], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10),
+        dict(num_hidden = 2, sizes = [100,100], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10),
+        dict(num_hidden = 2, sizes = [200,200], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10),
+        dict(num_hidden = 2, sizes = [300,300], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "sizes_2"), **options)
+
+    result_list = [result_50, result_100, result_200, result_300]
+    color_list = ['r', 'b', 'g', 'm']
+    description_list = ['50 hidden units', '100 hidden units', '200 hidden units', '300 hidden units']
+    title = ['Training loss', 'Validation loss']
+
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "sizes_2"), artifacts)
+
+    # Training and Validation loss for different sizes with one hidden layer
+
+    result_50_1, result_100_1, result_200_1, result_300_1 = run_sweep([
+        dict(num_hidden = 1, sizes = [50], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10),
+        dict(num_hidden = 1, sizes = [100], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10),
+        dict(num_hidden = 1, sizes = [200], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10),
+        dict(num_hidden = 1, sizes = [300], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 10)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "sizes_1"), **options)
+
+    result_list = [result_50_1, result_100_1, result_200_1, result_300_1]
+    color_list = ['r', 'b', 'g', 'm']
+    description_list = ['50 hidden units', '100 hidden units', '200 hidden units', '300 hidden units']
+    title = ['Training loss', 'Validation loss']
+
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "sizes_1"), artifacts)
+
+    # Training and Validation loss for different sizes with three hidden layers
+
+    result_50_3, result_100_3, result_200_3, result_300_3 = run_sweep([
+        dict(num_hidden = 3, sizes = [50, 50, 50], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 3, sizes = [75, 75, 75], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 3, sizes = [100, 100, 100], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 3, sizes = [125, 125, 125], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "sizes_3"), **options)
+
+    result_list = [result_50_3, result_100_3, result_200_3, result_300_3]
+    color_list = ['r', 'b', 'g', 'm']
+    description_list = ['50 hidden units', '100 hidden units', '200 hidden units', '300 hidden units']
+    title = ['Training loss', 'Validation loss']
+
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "sizes_3"), artifacts)
+
+    # Training and Validation loss for different sizes with four hidden layers
+
+    result_50_4, result_100_4, result_200_4, result_300_4 = run_sweep([
+        dict(num_hidden = 4, sizes = [50, 50, 50, 50], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 4, sizes = [75, 75, 75, 75], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 4, sizes = [100, 100, 100, 100], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 4, sizes = [125, 125, 125, 125], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "sizes_4"), **options)
+
+    result_list = [result_50_4, result_100_4, result_200_4, result_300_4]
+    color_list = ['r', 'b', 'g', 'm']
+    description_list = ['50 hidden units', '75 hidden units', '100 hidden units', '125 hidden units']
+    title = ['Training loss', 'Validation loss']
+
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "sizes_4"), artifacts)
+
+    # Training and Validation loss for different learning algorithms
+
+    result_adam, result_nag, result_mgd = run_sweep([
+        dict(num_hidden = 2, sizes = [50, 50], activation_func = 'relu', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 2, sizes = [50, 50], activation_func = 'relu', loss_func = 'ce', optim = 'nag', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 2, sizes = [50, 50], activation_func = 'relu', loss_func = 'ce', optim = 'momentum', batch_size = 20, num_epochs = 15)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "optimizers"), **options)
+
+    result_list = [result_adam, result_nag, result_mgd]
+    color_list = ['r', 'b', 'g']
+    description_list = ['Adam', 'Nestrov accelerated GD', 'Momentum GD']
+    title = ['Training loss', 'Validation loss']
+
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "optimizers"), artifacts)
+
+    # Training and Validation loss for different activation functions
 
-"""# Training and Validation loss for different activation functions"""
+    result_sig, result_tanh = run_sweep([
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'sigmoid', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'tanh', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "activations"), **options)
 
-result_sig = run_model(0.005, 0.5, 2, [100, 100], 'sigmoid', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_tanh = run_model(0.005, 0.5, 2, [100, 100], 'tanh', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
+    result_list = [result_sig, result_tanh]
+    color_list = ['r', 'b']
+    description_list = ['Sigmoid activation', 'Tanh activation']
+    title = ['Training loss', 'Validation loss']
 
-result_list = [result_sig, result_tanh]
-color_list = ['r', 'b']
-description_list = ['Sigmoid activation', 'Tanh activation']
-title = ['Training loss', 'Validation loss']
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "activations"), artifacts)
 
-plot_stuff(result_list, color_list, description_list, title)
+    # Training and Validation loss for different Loss functions
 
-"""# Training and Validation loss for different Loss functions"""
+    result_cross, result_square = run_sweep([
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'sigmoid', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'tanh', loss_func = 'sq', optim = 'adam', batch_size = 20, num_epochs = 15)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "losses"), **options)
 
-result_cross = run_model(0.005, 0.5, 2, [100, 100], 'sigmoid', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_square = run_model(0.005, 0.5, 2, [100, 100], 'tanh', 'sq', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
+    result_list = [result_cross, result_square]
+    color_list = ['r', 'b']
+    description_list = ['Cross entropy loss', 'Squared error loss']
+    title = ['Training loss', 'Validation loss']
 
-result_list = [result_cross, result_square]
-color_list = ['r', 'b']
-description_list = ['Cross entropy loss', 'Squared error loss']
-title = ['Training loss', 'Validation loss']
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "losses"), artifacts)
 
-plot_stuff(result_list, color_list, description_list, title)
+    # Training and Validation loss for different batch sizes
 
-"""# Training and Validation loss for different batch sizes"""
+    result_1, result_20, result_100, result_1000 = run_sweep([
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'sigmoid', loss_func = 'ce', optim = 'adam', batch_size = 1, num_epochs = 15),
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'sigmoid', loss_func = 'ce', optim = 'adam', batch_size = 20, num_epochs = 15),
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'sigmoid', loss_func = 'ce', optim = 'adam', batch_size = 100, num_epochs = 15),
+        dict(num_hidden = 2, sizes = [100, 100], activation_func = 'sigmoid', loss_func = 'ce', optim = 'adam', batch_size = 1000, num_epochs = 15)],
+      path_train, path_val, path_test, os.path.join(path_sweep_dir, "batch_sizes"), **options)
 
-result_1 = run_model(0.005, 0.5, 2, [100, 100], 'sigmoid', 'ce', 'adam', 1, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_20 = run_model(0.005, 0.5, 2, [100, 100], 'sigmoid', 'ce', 'adam', 20, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_100 = run_model(0.005, 0.5, 2, [100, 100], 'sigmoid', 'ce', 'adam', 100, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
-result_1000 = run_model(0.005, 0.5, 2, [100, 100], 'sigmoid', 'ce', 'adam', 1000, 15, path_save_dir, path_expt_dir, path_train, path_val, path_test, True, 0)
+    result_list = [result_1, result_20, result_100, result_1000]
+    color_list = ['r', 'b', 'g', 'm']
+    description_list = ['Batch size = 1', 'Batch size = 20', 'Batch size = 100', 'Batch size = 1000']
+    title = ['Training loss', 'Validation loss']
 
-result_list = [result_1, result_20, result_100, result_1000]
-color_list = ['r', 'b', 'g', 'm']
-description_list = ['Batch size = 1', 'Batch size = 20', 'Batch size = 100', 'Batch size = 1000']
-title = ['Training loss', 'Validation loss']
+    plot_stuff(result_list, color_list, description_list, title, os.path.join(path_sweep_dir, "batch_sizes"), artifacts)
 
-plot_stuff(result_list, color_list, description_list, title)
+    artifacts.close()
 
+if __name__ == "__main__":
+    main()
@@ -8,25 +8,55 @@ Original file is located at
 """
 
 import argparse
-import matplotlib.pyplot as plt 
-import matplotlib
+import functools
+import hashlib
+import importlib.util
+import multiprocessing
 import numpy as np 
 import os
 from os.path import join
-import pandas as pd
 import pickle 
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
+from concurrent.futures import ProcessPoolExecutor
 import sys
-plt.rcParams.update({'font.size': 22})
 from pathlib import Path
+# datautils.py at the top of the repository holds the helpers shared with the Feedforward script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from datautils import BackgroundWriter, cache_key, load_cached_csv, prefetch_iter, save_npy
+# pandas, sklearn, matplotlib, scipy and umap are imported by the functions that need them, so importing this file for 
+# the RBM class and the update functions only loads numpy. The script itself is run through main.
+# scipy is only needed for the sparse minibatches, see use_sparse and import_sparse
+sparse = None
 
 # n is the number of hidden units in the RBM
 # k is the number of steps of contrastive divergence to run per example
+# batch_size is the number of examples whose updates are summed into one weight update
 n = 100
 k = 1
 eta = 7e-4 
+batch_size = 32
+# the minibatches are drawn in a new random order every epoch and up to prefetch of them are prepared in the background
+shuffle = True
+prefetch = 4
+# persistent switches from CD-k to persistent contrastive divergence (PCD), where the negative phase comes from num_chains
+# Gibbs chains that carry over from one update to the next instead of restarting at the data
+persistent = False
+num_chains = 100
+# use_sparse trains on CSR minibatches, so the hidden activations and the positive phase of the update only touch the 
+# pixels that are on. That only pays off for sparse enough images, with "auto" it is used when at most max_density of the 
+# training pixels are on (thresholded MNIST is around 0.19, so it stays dense). It needs scipy, without it the minibatches 
+# stay dense
+use_sparse = "auto"
+max_density = 0.05
 num_epochs = 15
+# the hidden representations of the test images are written to a .npy memory map in the output folder when memmap_hidden
+memmap_hidden = False
+# The 2-D embeddings of the hidden representations (TSNE and UMAP) are fit on num_fit randomly chosen test images and the
+# rest are placed from their embedding_neighbors nearest fitted images, None fits all of them. The embeddings run at the 
+# same time in separate processes and are cached in the output folder by the model, the data and the settings.
+embedding_methods = {"tsne": {"n_components": 2, "early_exaggeration": 7},
+		"umap": {"n_neighbors": 5, "min_dist": 0.3, "metric": "correlation"}}
+num_fit = 3000
+embedding_neighbors = 10
 path_train = Path('/content/train.csv')
 path_test = Path('/content/test.csv')
 
@@ -43,217 +73,499 @@ path_test = Path('/content/test.csv')
 def sigmoid(z):
 	return 1/(1 + np.exp(-z))
 
+# Vectors are stored one example per row, so a minibatch of images has shape (batch, 784) and its hidden units (batch, n).
+
+rng = np.random.default_rng()
+
 def sample_vector(n, weight, vector, bias):
 	if vector.ndim == 1:
-		vector = vector[:, np.newaxis]
-	if bias.ndim == 1:
-		bias = bias[:, np.newaxis]
+		vector = vector[np.newaxis, :]
 
-	z_linear = np.dot(weight, vector) + bias
+	z_linear = np.dot(vector, weight.T) + np.reshape(bias, -1)
 	probs = sigmoid(z_linear)
-	if probs.ndim == 1:
-		probs = probs[:, np.newaxis]
  
-	assert np.shape(probs) == (n,1) 
-	random = np.random.random((n,1))
-	one = random < probs
-	zerovec = np.zeros((n,1))
-	zerovec[one] = 1
-	assert zerovec.ndim == 2
-	return zerovec
-
-"""Setting values"""
-
-threshold = 127
-path_folder = "./k" + str(k) + " n" + str(n) + " eta" + str(eta) + " epochs" + str(num_epochs)
-try:
-	os.mkdir(path_folder)
-except FileExistsError:
-    print("folder already exists. Name: " + path_folder)
-
-"""Preparing the data"""
-
-data_train_df = pd.read_csv(path_train)
-data_train = data_train_df.to_numpy()
-X_train = data_train[:,1:-1]
-print(f'X_train shape = {X_train.shape}')
-labels_train = data_train[:,-1]
-
-data_test_df = pd.read_csv(path_test)
-data_test = data_test_df.to_numpy()
-X_test = data_test[:,1:-1]
-print(f'X_test shape = {X_test.shape}')
-labels_test = data_test[:,-1]
-
-"""Thesholding"""
-
-greater = X_train >= threshold
-lesser = X_train < threshold
-
-X_train_thresh = X_train.copy()
-X_train_thresh[greater] = 1
-X_train_thresh[lesser] = 0
-print(f'Shape of X_train_thresh = {X_train_thresh.shape}')
-
-greater = X_test >= threshold
-lesser = X_test < threshold
-
-X_test_thresh = X_test.copy()
-X_test_thresh[greater] = 1
-X_test_thresh[lesser] = 0
-
-print("max", np.max(X_test_thresh), np.max(X_train_thresh))
-
-image_id = 1032
-image = np.reshape(X_train[image_id,:], (28,28))
-image_thresh = np.reshape(X_train_thresh[image_id, :], (28,28))
-
-plt.figure(figsize = (10,8))
-plt.imshow(image, cmap = "gray")
-plt.show()
-plt.close()
-
-plt.figure(figsize = (10,8))
-plt.imshow(image_thresh, cmap = "gray")
-plt.show()
-plt.close()
-
-"""Training RBM"""
-
-num_visible = np.shape(X_train_thresh)[1]
-print(num_visible)
-
-W = 0.01*np.random.randn(n, num_visible)
-# print(np.shape(W))
-b = np.zeros((num_visible,1))
-c = np.zeros((n,1))
-
-num_examples = np.shape(X_train_thresh)[0]
-print("number of examples: ", num_examples)
-h = np.zeros((n,1))
-image_id = 3
-image_thresh = np.reshape(X_train_thresh[image_id, :], (28,28))
-
-plt.figure(figsize = (10,8))
-plt.imshow(image_thresh, cmap = "gray")
-plt.savefig(join(path_folder, "original.png"))
-plt.close()
-
-image_temp = X_train_thresh[image_id,:]
-
-for epoch in range(num_epochs):
-	print("Epoch: ", epoch)
-	plt.figure(figsize = (20,16))
-	subplot_no = 1
-	for i in range(num_examples):
-		if ((i%(936) == 0)) and (subplot_no <= 64):
-			h_temp =  sample_vector(n, W, image_temp, c)
-			image_recon_temp1 = sample_vector(num_visible, W.T, h_temp, b)
-			image_recon_temp = np.reshape(image_recon_temp1, (28,28))
-			plt.subplot(8,8,subplot_no)
-			plt.imshow(image_recon_temp, cmap = "gray")
-			plt.axis("off")
-			subplot_no += 1
-
-		v = X_train_thresh[i,:]
-		if v.ndim == 1:
-			v = v[:, np.newaxis]
-		vtemp = X_train_thresh[i,:]
-		if vtemp.ndim == 1:
-			vtemp = vtemp[:, np.newaxis]
-
-    #  Gibbs sampling step
-		for t in range(k):
-			h = sample_vector(n, W, vtemp, c)
-			vtemp = sample_vector(num_visible, W.T, h, b)
-
-		z = sigmoid(np.dot(W,v) + c)
-		if z.ndim == 1:
-			z = z[:, np.newaxis]
-		ztemp = sigmoid(np.dot(W, vtemp) + c)
-		if ztemp.ndim == 1:
-			ztemp = ztemp[:, np.newaxis]
-
-		W = W + eta*(np.dot(z, v.T) - np.dot(ztemp, vtemp.T))
-		b = b + eta*(v - vtemp)
-		c = c + eta*(z - ztemp)
-
-	plt.savefig(join(path_folder,"changing_image"+ str(epoch) + ".png"))
-	plt.show()
-	plt.close()
-
-image = X_train_thresh[image_id,:]
-h = sample_vector(n, W, image, c)
-vtemp = sample_vector(num_visible, W.T, h, b)
-print(np.shape(vtemp))
-
-image = np.reshape(image, (28,28))
-vtemp = np.reshape(vtemp, (28,28))
-
-plt.figure()
-plt.imshow(image, cmap = "gray")
-plt.savefig(join(path_folder, "origafter.png"))
-plt.show()
-plt.close()
-
-plt.figure()
-plt.imshow(vtemp, cmap = "gray")
-plt.savefig(join(path_folder, "origarecon.png"))
-plt.show()
-plt.close()
-
-"""Computing the hidden representations for the test images using TSNE"""
-
-print("Computing the hidden representations for the training examples")
-print("Shape of test data: ", np.shape(X_test_thresh))
-
-num_test_examples = np.shape(X_test_thresh)[0]
-hidden_reps = []
-for i in range(num_test_examples):
-	image = X_test_thresh[i,:]
+	assert np.shape(probs) == (np.shape(vector)[0], n) 
+	random = rng.random(np.shape(probs))
+	return (random < probs).astype(probs.dtype)
+
+# sample_and_prob is the fused version of sample_vector used in training. It writes the probabilities, the sampled units and 
+# the uniform random numbers into preallocated buffers instead of allocating new arrays on every call. With sample = None
+# only the probabilities are computed. vector can be a sparse (CSR) minibatch.
+
+def import_sparse():
+	# returns scipy.sparse, or None when scipy is not installed
+	global sparse
+	if sparse is None:
+		try:
+			from scipy import sparse as module
+		except ImportError:
+			return None
+		sparse = module
+	return sparse
+
+def sample_and_prob(weight, vector, bias, probs, sample, random):
+	if sparse is not None and sparse.issparse(vector):
+		probs[...] = vector @ weight.T
+	else:
+		np.dot(vector, weight.T, out = probs)
+	probs += bias
+	# in place sigmoid
+	np.negative(probs, out = probs)
+	np.exp(probs, out = probs)
+	probs += 1
+	np.reciprocal(probs, out = probs)
+	if sample is not None:
+		rng.random(out = random, dtype = random.dtype)
+		np.less(random, probs, out = sample)
+	return probs, sample
+
+# The parameters and the buffers are float32 like the unpacked minibatches, so the products of the two never have to 
+# convert a copy of either.
+
+def create_buffers(batch_size, n, num_visible, dtype = np.float32):
+	buffers = {}
+	for name in ["ph_data", "h", "rand_h", "ph_model"]:
+		buffers[name] = np.zeros((batch_size, n), dtype = dtype)
+	for name in ["pv", "v", "rand_v"]:
+		buffers[name] = np.zeros((batch_size, num_visible), dtype = dtype)
+	buffers["dW"] = np.zeros((n, num_visible), dtype = dtype)
+	return buffers
+
+# The fantasy particles of PCD are the "v" buffer of a second set of buffers, so the whole pool is one contiguous 
+# (num_chains, visible) array that is advanced in place. The chains start from random binary images.
+
+def create_chains(num_chains, n, num_visible):
+	chains = create_buffers(num_chains, n, num_visible)
+	np.less(rng.random((num_chains, num_visible)), 0.5, out = chains["v"])
+	return chains
+
+def apply_update(V, ph_data, vneg, ph_model, W, b, c, eta, dW):
+	# The negative statistics are rescaled to the size of the minibatch, which only matters for PCD where the number of 
+	# chains can differ from the batch size.
+	scale = np.shape(V)[0]/np.shape(vneg)[0]
+	if sparse is not None and sparse.issparse(V):
+		# the positive statistics of a sparse minibatch only cost as much as its number of pixels that are on
+		dW[...] = (V.T @ ph_data).T
+		V_sum = np.asarray(V.sum(axis = 0)).ravel()
+	else:
+		np.dot(ph_data.T, V, out = dW)
+		V_sum = np.sum(V, axis = 0)
+	dW -= scale*np.dot(ph_model.T, vneg)
+	dW *= eta
+	W += dW
+	b += eta*(V_sum - scale*np.sum(vneg, axis = 0))
+	c += eta*(np.sum(ph_data, axis = 0) - scale*np.sum(ph_model, axis = 0))
+
+# cd_update runs k steps of block Gibbs sampling for a whole minibatch V of shape (batch, visible) and applies the 
+# contrastive divergence update, summed over the batch, to W, b and c in place.
+
+def cd_update(V, W, b, c, k, eta, buffers):
+	m = np.shape(V)[0]
+	ph_data, h, rand_h = buffers["ph_data"][:m], buffers["h"][:m], buffers["rand_h"][:m]
+	pv, vtemp, rand_v = buffers["pv"][:m], buffers["v"][:m], buffers["rand_v"][:m]
+	ph_model = buffers["ph_model"][:m]
+
+	# hidden probabilities given the data and the first hidden sample of the chain in one pass
+	sample_and_prob(W, V, c, ph_data, h, rand_h)
+
+	#  Gibbs sampling step
+	for t in range(k):
+		sample_and_prob(W.T, h, b, pv, vtemp, rand_v)
+		sample_and_prob(W, vtemp, c, ph_model, h, rand_h)
+
+	apply_update(V, ph_data, vtemp, ph_model, W, b, c, eta, buffers["dW"])
+
+# pcd_update takes the positive phase from the minibatch V and the negative phase from the persistent chains, which are
+# advanced k steps in batch and left where they end for the next update.
+
+def pcd_update(V, W, b, c, k, eta, buffers, chains):
+	m = np.shape(V)[0]
+	ph_data = buffers["ph_data"][:m]
+	sample_and_prob(W, V, c, ph_data, None, None)
+
+	fantasy = chains["v"]
+	sample_and_prob(W, fantasy, c, chains["ph_model"], chains["h"], chains["rand_h"])
+	for t in range(k):
+		sample_and_prob(W.T, chains["h"], b, chains["pv"], fantasy, chains["rand_v"])
+		sample_and_prob(W, fantasy, c, chains["ph_model"], chains["h"], chains["rand_h"])
+
+	apply_update(V, ph_data, fantasy, chains["ph_model"], W, b, c, eta, buffers["dW"])
+
+# The RBM class holds a trained (or training) model: W of shape (n, visible), the visible biases b and the hidden biases c.
+# The update functions above change these arrays in place. transform computes the hidden units of a whole matrix of 
+# images, chunk_size rows at a time, into one preallocated (num_images, n) float32 array. The output is a .npy memory map 
+# on disk when path is given, so the number of images is not limited by memory. unpack turns a chunk of rows of X into 
+# (chunk, visible) floats, for example unpack_batch for the bit packed images. With sample = True the hidden units are 
+# sampled like sample_vector does, otherwise their probabilities are returned.
+
+class RBM:
+	def __init__(self, num_visible, n, W = None, b = None, c = None):
+		self.num_visible = num_visible
+		self.n = n
+		# float32, see create_buffers
+		self.W = (0.01*np.random.randn(n, num_visible) if W is None else W).astype(np.float32, copy = False)
+		self.b = (np.zeros(num_visible) if b is None else b).astype(np.float32, copy = False)
+		self.c = (np.zeros(n) if c is None else c).astype(np.float32, copy = False)
+
+	def transform(self, X, unpack = None, sample = False, chunk_size = 4096, out = None, path = None):
+		num_images = np.shape(X)[0]
+		if out is None and path is not None:
+			out = np.lib.format.open_memmap(path, mode = "w+", dtype = np.float32, shape = (num_images, self.n))
+		elif out is None:
+			out = np.empty((num_images, self.n), dtype = np.float32)
+		chunk_size = max(1, min(chunk_size, num_images))
+		probs = np.empty((chunk_size, self.n), dtype = self.W.dtype)
+		samples = np.empty((chunk_size, self.n), dtype = self.W.dtype) if sample else None
+		random = np.empty((chunk_size, self.n), dtype = self.W.dtype) if sample else None
+
+		for j in range(0, num_images, chunk_size):
+			V = unpack(X[j:j + chunk_size]) if unpack is not None else np.asarray(X[j:j + chunk_size], dtype = float)
+			m = np.shape(V)[0]
+			if sample:
+				sample_and_prob(self.W, V, self.c, probs[:m], samples[:m], random[:m])
+				out[j:j + m] = samples[:m]
+			else:
+				sample_and_prob(self.W, V, self.c, probs[:m], None, None)
+				out[j:j + m] = probs[:m]
+		if isinstance(out, np.memmap):
+			out.flush()
+		return out
+
+	def save(self, path):
+		np.savez(path, W = self.W, b = self.b, c = self.c)
+
+	def fingerprint(self):
+		sha = hashlib.sha1()
+		for array in [self.W, self.b, self.c]:
+			sha.update(np.ascontiguousarray(array).tobytes())
+		return sha.hexdigest()
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as data:
+			W = data["W"]
+			return cls(np.shape(W)[1], np.shape(W)[0], W, data["b"], data["c"])
+
+# The first time a CSV is read it is converted to .npy files in a npy_cache folder next to it (the ids, the pixels as 
+# uint8 and the labels), keyed by a hash of the CSV. Every later run memory-maps those files instead of parsing the CSV.
+# See load_cached_csv in datautils.py.
+
+# The thresholded images are only ever 0 or 1, so they are cached bit packed, 8 pixels per byte, next to the uint8 pixels
+# (a 784 pixel image takes 98 bytes). The packed rows are unpacked to float32 one minibatch at a time by unpack_batch.
+
+def load_binarized(path_to_csv, threshold, cache_dir = None, chunk_size = 10000):
+	_, X, labels = load_cached_csv(path_to_csv, cache_dir = cache_dir)
+	cache_dir, key = cache_key(path_to_csv, cache_dir = cache_dir)
+	path_packed = cache_dir / (key + "_t" + str(threshold) + "_packed.npy")
+
+	if not path_packed.exists():
+		num_examples, num_visible = np.shape(X)
+		packed = np.empty((num_examples, (num_visible + 7)//8), dtype = np.uint8)
+		for start in range(0, num_examples, chunk_size):
+			packed[start:start + chunk_size] = np.packbits(X[start:start + chunk_size] >= threshold, axis = 1)
+		save_npy(path_packed, packed)
+
+	return np.load(path_packed, mmap_mode = "r"), np.shape(X)[1], labels
+
+# num_visible is the number of pixels of an image, which cuts off the padding bits of the last byte of a row. The 
+# unpacking functions are passed around with it bound by functools.partial, see main.
+
+def unpack_batch(packed, num_visible):
+	return np.unpackbits(packed, axis = 1, count = num_visible).astype(np.float32)
+
+def unpack_batch_sparse(packed, num_visible):
+	# the CSR arrays are built straight from the positions of the pixels that are on
+	num_rows = np.shape(packed)[0]
+	rows, columns = np.nonzero(np.unpackbits(packed, axis = 1, count = num_visible))
+	indptr = np.searchsorted(rows, np.arange(num_rows + 1))
+	data = np.ones(len(columns), dtype = np.float32)
+	return sparse.csr_matrix((data, columns, indptr), shape = (num_rows, num_visible))
+
+def pixel_density(packed, num_visible, num_rows = 1000):
+	# fraction of the pixels that are on, estimated from the first num_rows images
+	return np.mean(np.unpackbits(packed[:num_rows], axis = 1, count = num_visible))
+
+# stream_minibatches yields (batch, visible) float blocks of rows of X, which can be the memory map of load_binarized. 
+# A background thread gathers the rows of the next batches and applies transform (the unpacking) while the current 
+# batch is being trained on, so the whole training set never has to be unpacked and held in memory.
+
+def stream_minibatches(X, batch_size, transform, shuffle = True, prefetch = 4):
+	num_examples = np.shape(X)[0]
+	order = rng.permutation(num_examples) if shuffle else np.arange(num_examples)
+
+	def batches():
+		for start in range(0, num_examples, batch_size):
+			# sorted indices turn the gather into a forward scan over the memory map
+			yield transform(np.asarray(X[np.sort(order[start:start + batch_size])]))
+
+	yield from prefetch_iter(batches(), prefetch)
+
+# The embeddings of the hidden representations are fit on a random subset of num_fit rows only. Every other row is placed 
+# at the distance weighted mean of the embeddings of its nearest fitted rows, which costs a nearest neighbour query 
+# instead of a full TSNE or UMAP fit. TSNE has no transform for new points, so both methods are extended the same way.
+
+def fit_embedding(method, params, X, num_fit = None, num_neighbors = 10, seed = 1234):
+	num_rows = np.shape(X)[0]
+	if num_fit is None or num_fit >= num_rows:
+		fit = np.arange(num_rows)
+	else:
+		fit = np.sort(np.random.default_rng(seed).choice(num_rows, num_fit, replace = False))
+
+	from sklearn.neighbors import NearestNeighbors
+	if method == "tsne":
+		from sklearn.manifold import TSNE
+		model = TSNE(**params)
+	elif method == "umap":
+		import umap
+		model = umap.UMAP(**params)
+	else:
+		raise ValueError("unknown embedding method: " + method)
+	embedded = np.empty((num_rows, params.get("n_components", 2)))
+	embedded[fit] = model.fit_transform(X[fit])
+
+	rest = np.setdiff1d(np.arange(num_rows), fit)
+	if len(rest) > 0:
+		neighbors = NearestNeighbors(n_neighbors = min(num_neighbors, len(fit)), metric = params.get("metric", "euclidean"))
+		neighbors.fit(X[fit])
+		distances, indices = neighbors.kneighbors(X[rest])
+		weights = 1/(distances + 1e-8)
+		weights /= np.sum(weights, axis = 1, keepdims = True)
+		embedded[rest] = np.einsum("ij,ijk->ik", weights, embedded[fit][indices])
+	return embedded
+
+def embedding_key(method, params, model_key, data_key, num_fit, num_neighbors, seed):
+	settings = repr((method, sorted(params.items()), num_fit, num_neighbors, seed))
+	return hashlib.sha1((model_key + data_key + settings).encode()).hexdigest()[:16]
+
+# compute_embeddings returns a dict from method to the (rows, 2) embedding of X. Embeddings already computed for the same
+# model, data and settings are loaded from cache_dir, the missing ones are fit in parallel, one process per method.
+# Methods whose package is not installed (umap) are skipped.
+
+def compute_embeddings(X, methods, cache_dir, model_key, data_key, num_fit = None, num_neighbors = 10, seed = 1234, 
+		processes = None):
+	cache_dir = Path(cache_dir)
+	cache_dir.mkdir(parents = True, exist_ok = True)
+	embeddings, missing = {}, {}
+	for method, params in methods.items():
+		if method == "umap" and importlib.util.find_spec("umap") is None:
+			print("umap is not installed, skipping the UMAP embedding")
+			continue
+		key = embedding_key(method, params, model_key, data_key, num_fit, num_neighbors, seed)
+		path = cache_dir / (method + "_" + key + ".npy")
+		if path.exists():
+			print("Loading the " + method + " embedding from " + str(path))
+			embeddings[method] = np.load(path)
+		else:
+			missing[method] = path
+
+	X = np.asarray(X)
+	if len(missing) > 1 and processes != 1:
+		# spawned rather than forked, a fork while the BackgroundWriter thread is inside matplotlib can deadlock the child
+		context = multiprocessing.get_context("spawn")
+		with ProcessPoolExecutor(max_workers = processes or len(missing), mp_context = context) as pool:
+			futures = {method: pool.submit(fit_embedding, method, methods[method], X, num_fit, num_neighbors, seed) 
+					for method in missing}
+			results = {method: future.result() for method, future in futures.items()}
+	else:
+		results = {method: fit_embedding(method, methods[method], X, num_fit, num_neighbors, seed) for method in missing}
+
+	for method, path in missing.items():
+		save_npy(path, results[method])
+		embeddings[method] = results[method]
+	return embeddings
+
+# The figures of the run are rendered by a BackgroundWriter (see datautils.py) on the Agg canvas, so drawing and writing
+# the PNGs never holds up training. put queues a rendering function with its arguments, the arrays passed must not be 
+# changed afterwards.
+
+def save_figure(figure, path):
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	FigureCanvasAgg(figure)
+	figure.savefig(path)
+
+def save_images(path, images, rows = 1, cols = 1, figsize = None, axis = True):
+	from matplotlib.figure import Figure
+	figure = Figure(figsize = figsize)
+	for i, image in enumerate(images):
+		axes = figure.add_subplot(rows, cols, i + 1)
+		axes.imshow(np.reshape(image, (28,28)), cmap = "gray")
+		if not axis:
+			axes.axis("off")
+	save_figure(figure, path)
+
+def save_scatter(path, vis_x, vis_y, labels, title):
+	import matplotlib
+	from matplotlib.figure import Figure
+	figure = Figure(figsize = (20,16))
+	axes = figure.add_subplot(1, 1, 1)
+	axes.set_title(title)
+	axes.set_xlabel("x")
+	axes.set_ylabel("Y")
+	points = axes.scatter(vis_x, vis_y, c = labels, cmap = matplotlib.colormaps["jet"].resampled(10))
+	figure.colorbar(points, ticks = range(max(labels)))
+	save_figure(figure, path)
+
+# During an epoch only the parameters at each reconstruction snapshot are copied into a (64, ...) stack. The 
+# reconstructions of the snapshot image for all of them are computed in one batched pass in the writer thread, with its own
+# random generator, and drawn as the 8x8 grid of the epoch.
+
+def save_reconstructions(path, image, Ws, bs, cs):
+	snapshot_rng = np.random.default_rng()
+	ph = sigmoid(np.einsum("sij,j->si", Ws, image) + cs)
+	h = (snapshot_rng.random(np.shape(ph)) < ph).astype(np.float32)
+	pv = sigmoid(np.einsum("sij,si->sj", Ws, h) + bs)
+	v = (snapshot_rng.random(np.shape(pv)) < pv).astype(np.float32)
+	save_images(path, v, 8, 8, (20,16), axis = False)
+
+# main runs the whole experiment: it trains an RBM on the thresholded training images, saves the reconstruction figures
+# and the model in the output folder and plots the embeddings of the hidden representations of the test images. The 
+# settings at the top of the file are the defaults of its command line options.
+
+def parse_args(argv = None):
+	parser = argparse.ArgumentParser(description = "Trains an RBM on thresholded MNIST and plots the embeddings of the test images")
+	parser.add_argument("--train", type = Path, default = path_train, help = "training CSV")
+	parser.add_argument("--test", type = Path, default = path_test, help = "test CSV")
+	parser.add_argument("--hidden", type = int, default = n, help = "number of hidden units")
+	parser.add_argument("-k", type = int, default = k, help = "number of Gibbs steps per update")
+	parser.add_argument("--eta", type = float, default = eta)
+	parser.add_argument("--batch-size", type = int, default = batch_size)
+	parser.add_argument("--epochs", type = int, default = num_epochs)
+	parser.add_argument("--persistent", action = "store_true", default = persistent, help = "train with PCD")
+	parser.add_argument("--chains", type = int, default = num_chains, help = "number of PCD chains")
+	parser.add_argument("--sparse", choices = ["auto", "yes", "no"], default = use_sparse if use_sparse == "auto" else 
+			("yes" if use_sparse else "no"))
+	parser.add_argument("--memmap-hidden", action = "store_true", default = memmap_hidden)
+	parser.add_argument("--num-fit", type = int, default = num_fit, help = "number of test images the embeddings are fit on")
+	return parser.parse_args(argv)
+
+def main(argv = None):
+	args = parse_args(argv)
+	import matplotlib
+	matplotlib.rcParams.update({'font.size': 22})
+	path_train, path_test = args.train, args.test
+	n, k, eta, batch_size, num_epochs = args.hidden, args.k, args.eta, args.batch_size, args.epochs
+	persistent, num_chains, memmap_hidden, num_fit = args.persistent, args.chains, args.memmap_hidden, args.num_fit
+	use_sparse = args.sparse if args.sparse == "auto" else args.sparse == "yes"
+
+	# Setting values
+
+	threshold = 127
+	path_folder = "./k" + str(k) + " n" + str(n) + " eta" + str(eta) + " epochs" + str(num_epochs)
+	if persistent:
+		path_folder = path_folder + " pcd" + str(num_chains)
+	try:
+		os.mkdir(path_folder)
+	except FileExistsError:
+	    print("folder already exists. Name: " + path_folder)
+
+	# Preparing the data
+
+	_, X_train, labels_train = load_cached_csv(path_train)
+	print(f'X_train shape = {X_train.shape}')
+
+	_, X_test, labels_test = load_cached_csv(path_test)
+	print(f'X_test shape = {X_test.shape}')
+
+	# Thesholding
+
+	# X_train_thresh and X_test_thresh are the bit packed thresholded images, see load_binarized
+	X_train_thresh, num_visible, _ = load_binarized(path_train, threshold)
+	print(f'Shape of X_train_thresh = {X_train_thresh.shape}, {X_train_thresh.nbytes} bytes')
+
+	X_test_thresh, _, _ = load_binarized(path_test, threshold)
+	unpack = functools.partial(unpack_batch, num_visible = num_visible)
+
+	image_id = 1032
+	image = np.reshape(X_train[image_id,:], (28,28))
+	image_thresh = np.reshape(unpack(X_train_thresh[image_id:image_id + 1]), (28,28))
+
+	artifacts = BackgroundWriter()
+	artifacts.put(save_images, join(path_folder, "image.png"), [image], 1, 1, (10,8))
+	artifacts.put(save_images, join(path_folder, "image_thresh.png"), [image_thresh], 1, 1, (10,8))
+
+	# Training RBM
+
+	print(num_visible)
+
+	rbm = RBM(num_visible, n)
+	# the training updates work on the parameters of the model in place
+	W, b, c = rbm.W, rbm.b, rbm.c
+
+	num_examples = np.shape(X_train_thresh)[0]
+	print("number of examples: ", num_examples)
+	buffers = create_buffers(batch_size, n, num_visible)
+	if persistent:
+		chains = create_chains(num_chains, n, num_visible)
+	image_id = 3
+	image_thresh = np.reshape(unpack(X_train_thresh[image_id:image_id + 1]), (28,28))
+
+	artifacts.put(save_images, join(path_folder, "original.png"), [image_thresh], 1, 1, (10,8))
+
+	image_temp = unpack(X_train_thresh[image_id:image_id + 1])[0]
+
+	if use_sparse == "auto":
+		density = pixel_density(X_train_thresh, num_visible)
+		use_sparse = density <= max_density
+		print("pixel density: %.3f, sparse minibatches: %s" % (density, use_sparse))
+	if use_sparse and import_sparse() is None:
+		print("scipy is not installed, training on dense minibatches")
+	unpack_sparse = functools.partial(unpack_batch_sparse, num_visible = num_visible)
+	transform = unpack_sparse if use_sparse and sparse is not None else unpack
+
+	for epoch in range(num_epochs):
+		print("Epoch: ", epoch)
+		# the stacks are new every epoch because the writer may still be reading those of the previous one
+		Ws = np.empty((64, n, num_visible), dtype = np.float32)
+		bs = np.empty((64, num_visible), dtype = np.float32)
+		cs = np.empty((64, n), dtype = np.float32)
+		num_snapshots = 0
+		for batch_no, V in enumerate(stream_minibatches(X_train_thresh, batch_size, transform, shuffle, prefetch)):
+			i = batch_no*batch_size
+			# a snapshot is taken in the batch that contains every 936th example
+			if ((i%(936) < batch_size)) and (num_snapshots < 64):
+				Ws[num_snapshots], bs[num_snapshots], cs[num_snapshots] = W, b, c
+				num_snapshots += 1
+
+			if persistent:
+				pcd_update(V, W, b, c, k, eta, buffers, chains)
+			else:
+				cd_update(V, W, b, c, k, eta, buffers)
+
+		artifacts.put(save_reconstructions, join(path_folder,"changing_image"+ str(epoch) + ".png"), image_temp, 
+				Ws[:num_snapshots], bs[:num_snapshots], cs[:num_snapshots])
+
+	image = unpack(X_train_thresh[image_id:image_id + 1])[0]
 	h = sample_vector(n, W, image, c)
-	hidden_reps.append(np.array(h[:,0]))
-
-print(np.shape(hidden_reps))
-
-hidden_reps = np.array(hidden_reps)
+	vtemp = sample_vector(num_visible, W.T, h, b)
+	print(np.shape(vtemp))
 
-embedded = TSNE(n_components = 2, early_exaggeration = 7).fit_transform(hidden_reps)
-print(np.shape(embedded))
+	artifacts.put(save_images, join(path_folder, "origafter.png"), [image])
+	artifacts.put(save_images, join(path_folder, "origarecon.png"), [vtemp])
 
-# path_pickle = join(path_folder, "embedded.pickle")
+	# Computing the hidden representations for the test images using TSNE and UMAP
 
-vis_x = embedded[:,0]
-vis_y = embedded[:,1]
+	print("Computing the hidden representations for the training examples")
+	print("Shape of test data: ", np.shape(X_test_thresh))
 
-print(np.shape(labels_test))
+	rbm.save(join(path_folder, "rbm.npz"))
+	path_hidden = join(path_folder, "hidden_reps_test.npy") if memmap_hidden else None
+	hidden_reps = rbm.transform(X_test_thresh, transform, sample = True, path = path_hidden)
 
-plt.figure(figsize = (20,16))
-plt.title("Embeddings for testing examples, k = " + str(k))
-plt.xlabel("x")
-plt.ylabel("Y")
-plt.scatter(vis_x[:10000], vis_y[:10000], c = labels_test[:10000], cmap = plt.cm.get_cmap("jet", 10))
-plt.colorbar(ticks = range(max(labels_test)))
-plt.savefig(join(path_folder, "clusters_test.png"))
-plt.show()
-plt.close()
+	print(np.shape(hidden_reps))
 
-"""Computing the hidden representations for the test images using UMAP"""
+	_, data_key = cache_key(path_test)
+	embeddings = compute_embeddings(hidden_reps, embedding_methods, join(path_folder, "embeddings"), rbm.fingerprint(), 
+			data_key + "_t" + str(threshold), num_fit, embedding_neighbors)
 
-import umap
-embedding = umap.UMAP(n_neighbors=5, min_dist=0.3, metric='correlation').fit_transform(hidden_reps)
-print(np.shape(embedding))
+	print(np.shape(labels_test))
 
-vis_x = embedding[:,0]
-vis_y = embedding[:,1]
+	for method, embedded in embeddings.items():
+		print(method, np.shape(embedded))
+		path_plot = join(path_folder, "clusters_test.png" if method == "tsne" else "clusters_test_" + method + ".png")
+		artifacts.put(save_scatter, path_plot, embedded[:10000,0], embedded[:10000,1], np.asarray(labels_test[:10000]), 
+				"Embeddings for testing examples, k = " + str(k))
 
-plt.figure(figsize = (20,16))
-plt.title("Embeddings for testing examples, k = " + str(k))
-plt.xlabel("x")
-plt.ylabel("Y")
-plt.scatter(vis_x[:10000], vis_y[:10000], c = labels_test[:10000], cmap = plt.cm.get_cmap("jet", 10))
-plt.colorbar(ticks = range(max(labels_test)))
-plt.savefig(join(path_folder, "clusters_test_umap.png"))
-plt.show()
-plt.close()
+	artifacts.close()
 
+if __name__ == "__main__":
+	main()
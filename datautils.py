@@ -0,0 +1,145 @@
+# Helpers shared by Feedforward/feedforwardnn.py and RBM/rbm_train.py. Both scripts put the top of the repository on
+# sys.path and import them from here.
+
+import functools
+import hashlib
+import numpy as np
+import os
+import queue
+import threading
+from pathlib import Path
+
+# Parsing the CSVs with pandas is a large part of the time of a short experiment. The first time a CSV is read it is
+# converted to .npy files in cache_dir (by default a npy_cache folder next to the CSV): the ids, the pixels as uint8 and,
+# for labelled files, the labels. The files are keyed by a hash of the CSV, so an edited CSV is converted again, and
+# every later read is a zero-copy, read-only memory map.
+
+def file_hash(path):
+    # The hash is remembered for as long as the size and modification time of the file do not change
+    stat = os.stat(path)
+    return hash_file_contents(str(path), stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize = None)
+def hash_file_contents(path, size, mtime_ns, block_size = 1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def save_npy(path, array):
+    # written under a temporary name first so an interrupted conversion never leaves a truncated cache file
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, 'wb') as handle:
+        np.save(handle, array)
+    os.replace(tmp_path, path)
+
+def cache_key(path_to_csv, labelled = True, cache_dir = None):
+    # Returns the cache folder of a CSV and the prefix of its cached files
+    path_to_csv = Path(path_to_csv)
+    if cache_dir is None:
+        cache_dir = path_to_csv.parent / "npy_cache"
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents = True, exist_ok = True)
+    return cache_dir, path_to_csv.stem + "_" + file_hash(path_to_csv)[:16] + ("_labelled" if labelled else "_unlabelled")
+
+def load_cached_csv(path_to_csv, labelled = True, cache_dir = None):
+    # Returns ids, X and labels with one row of X per example. labels is None for unlabelled files.
+    cache_dir, key = cache_key(path_to_csv, labelled, cache_dir)
+    paths = {name: cache_dir / (key + "_" + name + ".npy") for name in ["ids", "X", "labels"]}
+
+    if not paths["X"].exists():
+        print("Converting " + str(path_to_csv) + " to " + str(cache_dir))
+        import pandas as pd
+        data = pd.read_csv(path_to_csv).to_numpy()
+        if labelled:
+            X = data[:,1:-1]
+            save_npy(paths["labels"], data[:,-1].astype(int))
+        else:
+            X = data[:,1:]
+        if np.issubdtype(X.dtype, np.integer) and np.min(X) >= 0 and np.max(X) <= 255:
+            X = X.astype(np.uint8)
+        save_npy(paths["ids"], data[:,0])
+        # X is written last, its presence marks a complete conversion
+        save_npy(paths["X"], X)
+
+    ids = np.load(paths["ids"], mmap_mode = "r")
+    X = np.load(paths["X"], mmap_mode = "r")
+    labels = np.load(paths["labels"], mmap_mode = "r") if labelled else None
+    return ids, X, labels
+
+# prefetch_iter runs the iterator batches in a background thread and yields its items, keeping up to size of them ready
+# in a queue, so that producing the next minibatches (disk reads, unpacking, normalization) overlaps with the training
+# step. An error in the producer is raised in the consumer.
+
+def prefetch_iter(batches, size = 4):
+    items = queue.Queue(maxsize = max(size, 1))
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for batch in batches:
+                while not stop.is_set():
+                    try:
+                        items.put(batch, timeout = 0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put(None)
+        except BaseException as error:
+            items.put(error)
+
+    thread = threading.Thread(target = worker, daemon = True)
+    thread.start()
+    try:
+        while True:
+            batch = items.get()
+            if batch is None:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+    finally:
+        # the consumer may stop early, so the worker is told to stop instead of blocking on a full queue
+        stop.set()
+        thread.join()
+
+# BackgroundWriter runs the functions put on its queue, put(function, *args), one after the other in a worker thread, so
+# the caller only waits when maxsize of them are already pending. It writes checkpoints and renders plots. An error in the
+# worker is raised by the next put or by close.
+
+class BackgroundWriter:
+    def __init__(self, maxsize = 8):
+        self.items = queue.Queue(maxsize = maxsize)
+        self.thread = None
+        self.error = None
+
+    def put(self, function, *args):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.run, daemon = True)
+            self.thread.start()
+        self.items.put((function, args))
+
+    def run(self):
+        while True:
+            item = self.items.get()
+            if item is None:
+                return
+            function, args = item
+            try:
+                function(*args)
+            except BaseException as error:
+                self.error = error
+
+    def close(self):
+        # waits for the pending items
+        if self.thread is not None:
+            self.items.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error